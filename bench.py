@@ -0,0 +1,482 @@
+#!/usr/bin/python
+"""
+Benchmarks for the Zope 2 export tools.
+
+Usage:
+
+    bin/zopepy bench.py [options] benchmark-name
+
+Run it with a Python that can import Zope 2 (bin/zopepy after make).
+Each benchmark builds its own synthetic input in a temporary directory.
+
+Licenced under the Zope Public Licence (ZPL) version 2.1.  Find a copy
+in your Zope 2 distribution (without which this script is useless).
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import marshal
+import multiprocessing
+import tempfile
+import optparse
+import filecmp
+import subprocess
+from cStringIO import StringIO
+
+import transaction
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+from Acquisition import aq_base
+from OFS.Folder import Folder
+from OFS import XMLExportImport
+
+import z2loader
+import z2writer
+import z2cache
+import zexp
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+benchmark_registry = {}
+
+
+def benchmark(name):
+    def decorator(fn):
+        benchmark_registry[name] = fn
+        return fn
+    return decorator
+
+
+def make_flat_tree(dirname, count, size=100):
+    os.mkdir(dirname)
+    for n in range(count):
+        f = file(os.path.join(dirname, 'file%06d.txt' % n), 'wb')
+        f.write('x' * size)
+        f.close()
+
+
+def make_site(dirname, count, size=10000, per_folder=100, text=False):
+    """Create a tree of folders with count files of the given size.
+
+    With text=True the files hold random words, which compress about as
+    well as real text does, instead of one number over and over.
+    """
+    rng = random.Random(count)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                     for i in range(rng.randint(2, 10)))
+             for i in range(2000)]
+    for n in range(count):
+        folder = os.path.join(dirname, 'folder%04d' % (n // per_folder))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        if text:
+            data = []
+            length = 0
+            while length < size:
+                data.append(rng.choice(words))
+                length += len(data[-1]) + 1
+            data = ' '.join(data)[:size]
+        else:
+            data = ('%06d' % n) * (size // 6)
+        f = file(os.path.join(folder, 'file%06d.txt' % n), 'wb')
+        f.write(data)
+        f.close()
+
+
+SCRIPT = """## Script (Python) "%(name)s"
+##parameters=items
+total = 0
+for item in items:
+    if item %% %(n)d == 0:
+        total += item * 2
+    else:
+        total -= len(str(item))
+return total
+"""
+
+
+def make_scripts(dirname, count, per_folder=100):
+    """Create a tree of folders with count Python scripts."""
+    for n in range(count):
+        folder = os.path.join(dirname, 'folder%04d' % (n // per_folder))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        name = 'script%06d' % n
+        f = file(os.path.join(folder, name + '.py'), 'w')
+        f.write(SCRIPT % dict(name=name, n=n % 7 + 2))
+        f.close()
+
+
+TEMPLATE = """<html metal:define-macro="page">
+<head><title tal:content="template/title_or_id">%(name)s</title></head>
+<body>
+<h1 tal:content="string:${template/id} (%(n)d)">Title</h1>
+<ul tal:condition="python:%(n)d > 1">
+<li tal:repeat="item python:range(%(n)d)" tal:content="item">item</li>
+</ul>
+<p tal:condition="request/foo | nothing" tal:content="request/foo">foo</p>
+<div metal:define-slot="body">body</div>
+</body>
+</html>
+"""
+
+
+def make_templates(dirname, count, per_folder=100):
+    """Create a tree of folders with count Page Templates."""
+    for n in range(count):
+        folder = os.path.join(dirname, 'folder%04d' % (n // per_folder))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        name = 'page%06d' % n
+        f = file(os.path.join(folder, name + '.pt'), 'w')
+        f.write(TEMPLATE % dict(name=name, n=n % 7 + 2))
+        f.close()
+
+
+def timed(fn, *args, **kw):
+    start = time.time()
+    result = fn(*args, **kw)
+    return time.time() - start, result
+
+
+@benchmark('folder')
+def bench_folder(opts, tmpdir):
+    """load time of a single folder with N small files"""
+    print "%8s %10s %12s %14s" % ('files', 'load (s)', 'us/object',
+                                  '_setObject (s)')
+    for count in opts.sizes:
+        dirname = os.path.join(tmpdir, 'folder%d' % count)
+        make_flat_tree(dirname, count)
+        elapsed, folder = timed(z2loader.load_object, dirname)
+        # For comparison: the old way of populating a folder
+        items = folder.objectItems()
+        empty = Folder('empty')
+        start = time.time()
+        for id, ob in items:
+            empty._setObject(id, aq_base(ob))
+        setobject = time.time() - start
+        print "%8d %10.3f %12.1f %14.3f" % (count, elapsed,
+                                             elapsed / count * 1e6,
+                                             setobject)
+        shutil.rmtree(dirname)
+
+
+def same_tree(a, b):
+    cmp = filecmp.dircmp(a, b)
+    if cmp.left_only or cmp.right_only or cmp.diff_files or cmp.funny_files:
+        return False
+    for name in cmp.common_dirs:
+        if not same_tree(os.path.join(a, name), os.path.join(b, name)):
+            return False
+    return True
+
+
+def check(condition, msg):
+    if not condition:
+        sys.exit('FAILED: %s' % msg)
+
+
+def run_script(script, *args):
+    """Run one of the tools; returns wall-clock time and peak RSS in KB."""
+    # A wrapper process, so RUSAGE_CHILDREN covers only this one run
+    code = ('import sys, resource, subprocess\n'
+            'subprocess.check_call(sys.argv[1:])\n'
+            'print resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss\n')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    cmd = [sys.executable, '-c', code, sys.executable,
+           os.path.join(here, script)] + list(args)
+    start = time.time()
+    output = subprocess.Popen(cmd, env=env,
+                              stdout=subprocess.PIPE).communicate()[0]
+    return time.time() - start, int(output.split()[-1])
+
+
+@benchmark('storage')
+def bench_storage(opts, tmpdir):
+    """peak RSS of pack/unpack with in-memory and file scratch storage"""
+    print "%8s %-8s %-8s %10s %12s" % ('files', 'tool', 'storage',
+                                       'time (s)', 'peak RSS (MB)')
+    for count in opts.sizes:
+        dirname = os.path.join(tmpdir, 'site%d' % count)
+        zexpfile = dirname + '.zexp'
+        make_site(dirname, count, size=opts.file_size)
+        for storage in 'memory', 'file':
+            elapsed, rss = run_script('pack.py', '-o', zexpfile,
+                                      '--storage', storage, dirname)
+            print "%8d %-8s %-8s %10.3f %12.1f" % (count, 'pack', storage,
+                                                   elapsed, rss / 1024.0)
+        for storage in 'memory', 'file':
+            target = os.path.join(tmpdir, 'unpacked')
+            elapsed, rss = run_script('unpack.py', '--storage', storage,
+                                      zexpfile, target)
+            print "%8d %-8s %-8s %10.3f %12.1f" % (count, 'unpack', storage,
+                                                   elapsed, rss / 1024.0)
+            shutil.rmtree(target)
+        elapsed, rss = run_script('unpack.py', '--stream', zexpfile, target)
+        print "%8d %-8s %-8s %10.3f %12.1f" % (count, 'unpack', 'stream',
+                                               elapsed, rss / 1024.0)
+        shutil.rmtree(target)
+        shutil.rmtree(dirname)
+        os.unlink(zexpfile)
+
+
+def same_files(source, rendered):
+    """Check that render -o copied every file of source unchanged.
+
+    Pages, files included, are rendered with a newline at the end.
+    """
+    for dirpath, dirnames, filenames in os.walk(source):
+        for name in filenames:
+            filename = os.path.join(dirpath, name)
+            target = os.path.join(rendered,
+                                  os.path.relpath(filename, source))
+            if not os.path.isfile(target):
+                return False
+            if file(target, 'rb').read() != file(filename, 'rb').read() + '\n':
+                return False
+    return True
+
+
+@benchmark('render')
+def bench_render(opts, tmpdir):
+    """render -o time of files over a Pdata chunk, checked against the files"""
+    print "%8s %-22s %10s" % ('files', 'run', 'render (s)')
+    for count in opts.sizes:
+        dirname = os.path.join(tmpdir, 'site%d' % count)
+        cachefile = os.path.join(tmpdir, 'site.z2cache')
+        make_site(dirname, count, size=3 * z2loader.CHUNK_SIZE + 1, text=True)
+        # a cache filled by pack-zexp holds Pdata chains
+        subprocess.check_call([sys.executable, os.path.join(here, 'pack.py'),
+                               '--cache', cachefile,
+                               '-o', dirname + '.zexp', dirname])
+        runs = [('plain', []),
+                ('-j 2', ['-j', '2']),
+                ('--cache from pack', ['--cache', cachefile]),
+                ('--cache', ['--cache', cachefile]),
+                ('--incremental', ['--incremental']),
+                ('--incremental again', ['--incremental'])]
+        target = os.path.join(tmpdir, 'rendered')
+        for name, args in runs:
+            if os.path.exists(target) and not name.endswith('again'):
+                shutil.rmtree(target)
+            cmd = ([sys.executable, os.path.join(here, 'render.py')] + args +
+                   ['-o', target, dirname])
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+            start = time.time()
+            subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE).communicate()
+            elapsed = time.time() - start
+            check(same_files(dirname, target),
+                  'render %s output differs from the files' % name)
+            print "%8d %-22s %10.3f" % (count, name, elapsed)
+        shutil.rmtree(target)
+        shutil.rmtree(dirname)
+        os.unlink(dirname + '.zexp')
+        os.unlink(cachefile)
+
+
+@benchmark('big-file')
+def bench_big_file(opts, tmpdir):
+    """unpack time and peak RSS of one file of N Pdata chunks, with --stream"""
+    print "%8s %8s %-8s %10s %14s" % ('chunks', 'MB', 'mode', 'time (s)',
+                                      'peak RSS (MB)')
+    for count in opts.sizes:
+        dirname = os.path.join(tmpdir, 'site%d' % count)
+        zexpfile = dirname + '.zexp'
+        os.mkdir(dirname)
+        f = file(os.path.join(dirname, 'big.bin'), 'wb')
+        for n in range(count):
+            f.write(os.urandom(z2loader.CHUNK_SIZE))
+        f.close()
+        run_script('pack.py', '-o', zexpfile, dirname)
+        for mode in 'memory', 'stream':
+            target = os.path.join(tmpdir, 'unpacked')
+            if mode == 'stream':
+                args = ('--stream', zexpfile, target)
+            else:
+                args = (zexpfile, target)
+            elapsed, rss = run_script('unpack.py', *args)
+            check(filecmp.cmp(os.path.join(dirname, 'big.bin'),
+                              os.path.join(target, 'big.bin'), shallow=False),
+                  'unpack %s output differs from the file' % mode)
+            print "%8d %8.1f %-8s %10.3f %14.1f" % (
+                count, count * z2loader.CHUNK_SIZE / 1048576.0, mode,
+                elapsed, rss / 1024.0)
+            shutil.rmtree(target)
+        shutil.rmtree(dirname)
+        os.unlink(zexpfile)
+
+
+@benchmark('pack-jobs')
+def bench_pack_jobs(opts, tmpdir):
+    """pack time of a tree of Python scripts with 1, 2, 4 and 8 processes"""
+    print "%d CPUs" % multiprocessing.cpu_count()
+    print "%8s %6s %10s %8s" % ('scripts', 'jobs', 'pack (s)', 'speedup')
+    for count in opts.sizes:
+        dirname = os.path.join(tmpdir, 'site%d' % count)
+        zexpfile = dirname + '.zexp'
+        make_scripts(dirname, count)
+        serial = None
+        for jobs in 1, 2, 4, 8:
+            elapsed, rss = run_script('pack.py', '-j', str(jobs),
+                                      '-o', zexpfile, dirname)
+            if serial is None:
+                serial = elapsed
+            print "%8d %6d %10.3f %8.2f" % (count, jobs, elapsed,
+                                            serial / elapsed)
+            os.unlink(zexpfile)
+        shutil.rmtree(dirname)
+
+
+@benchmark('compile-cache')
+def bench_compile_cache(opts, tmpdir):
+    """load time of scripts and templates with a cold and warm compile cache"""
+    print "%8s %12s %10s %10s %8s" % ('objects', 'no cache (s)', 'cold (s)',
+                                      'warm (s)', 'speedup')
+    for count in opts.sizes:
+        dirname = os.path.join(tmpdir, 'site%d' % count)
+        make_scripts(dirname, count // 2)
+        make_templates(dirname, count - count // 2)
+        t_none, plain = timed(z2loader.load_object, dirname)
+        cachedir = os.path.join(tmpdir, 'compiled')
+        compile_cache = z2cache.CompileCache(cachedir)
+        t_cold, cold = timed(z2loader.load_object, dirname,
+                             compile_cache=compile_cache)
+        compile_cache = z2cache.CompileCache(cachedir)
+        t_warm, warm = timed(z2loader.load_object, dirname,
+                             compile_cache=compile_cache)
+        check(compile_cache.misses == 0,
+              '%d cache misses on a warm cache' % compile_cache.misses)
+        for folder_id in plain.objectIds():
+            folder = plain[folder_id]
+            for id, ob in folder.objectItems('Script (Python)'):
+                # marshal output depends on string interning, so compare
+                # the code objects
+                check(marshal.loads(warm[folder_id][id]._code) ==
+                      marshal.loads(ob._code),
+                      '%s/%s compiled differently' % (folder_id, id))
+        print "%8d %12.3f %10.3f %10.3f %8.2f" % (count, t_none, t_cold,
+                                                  t_warm, t_none / t_warm)
+        shutil.rmtree(cachedir)
+        shutil.rmtree(dirname)
+
+
+@benchmark('compression')
+def bench_compression(opts, tmpdir):
+    """pack/unpack time and size with compressed export files"""
+    print "%8s %-6s %10s %10s %12s" % ('files', 'ext', 'pack (s)',
+                                       'unpack (s)', 'size (MB)')
+    extensions = ['', '.gz', '.bz2']
+    if zexp.lzma is not None:
+        extensions.append('.xz')
+    for count in opts.sizes:
+        dirname = os.path.join(tmpdir, 'site%d' % count)
+        target = os.path.join(tmpdir, 'unpacked')
+        make_site(dirname, count, text=True)
+        for ext in extensions:
+            zexpfile = dirname + '.zexp' + ext
+            t_pack, rss = run_script('pack.py', '-o', zexpfile, dirname)
+            t_unpack, rss = run_script('unpack.py', zexpfile, target)
+            size = os.path.getsize(zexpfile) / 1048576.0
+            print "%8d %-6s %10.3f %10.3f %12.1f" % (count, ext or '-',
+                                                     t_pack, t_unpack, size)
+            shutil.rmtree(target)
+            os.unlink(zexpfile)
+        shutil.rmtree(dirname)
+
+
+@benchmark('xml')
+def bench_xml(opts, tmpdir):
+    """XML export/import speed, checked against OFS.XMLExportImport"""
+    print "%8s %8s %14s %14s %14s %14s" % ('files', 'MB', 'exportXML',
+                                           'zexp_to_xml', 'importXML',
+                                           'xml_to_zexp')
+    for count in opts.sizes:
+        dirname = os.path.join(tmpdir, 'site%d' % count)
+        make_site(dirname, count, size=1000)
+        db = DB(MappingStorage())
+        conn = db.open()
+        ob = z2loader.load_object(dirname, jar=conn)
+        conn.root()['site'] = ob
+        transaction.commit()
+        xml = StringIO()
+        t_export, _ = timed(XMLExportImport.exportXML, conn, ob._p_oid, xml)
+        xml = xml.getvalue()
+        exported = StringIO()
+        conn.exportFile(ob._p_oid, exported)
+        exported.seek(0)
+        converted = StringIO()
+        t_to_xml, _ = timed(zexp.zexp_to_xml, exported, converted)
+        check(converted.getvalue() == xml,
+              'zexp_to_xml() output differs from exportXML()')
+        try:
+            t_import, stock = timed(XMLExportImport.importXML, conn,
+                                    StringIO(xml))
+        except (UnicodeDecodeError, NameError):
+            # ppml fails on long strings and on memo ids over 127 when
+            # expat returns unicode, and on memo ids over 255 anyway
+            # (xml_to_zexp() works around both)
+            t_import = stock = None
+        def import_xml():
+            converted = tempfile.TemporaryFile()
+            zexp.xml_to_zexp(StringIO(xml), converted)
+            converted.seek(0)
+            return conn.importFile(converted)
+        t_to_zexp, imported = timed(import_xml)
+        z2writer.write_object(ob, os.path.join(tmpdir, 'original'))
+        z2writer.write_object(imported, os.path.join(tmpdir, 'streamed'))
+        check(same_tree(os.path.join(tmpdir, 'original'),
+                        os.path.join(tmpdir, 'streamed')),
+              'xml_to_zexp() imports differ from the exported objects')
+        if stock is not None:
+            z2writer.write_object(stock, os.path.join(tmpdir, 'stock'))
+            check(same_tree(os.path.join(tmpdir, 'stock'),
+                            os.path.join(tmpdir, 'streamed')),
+                  'xml_to_zexp() imports differ from importXML()')
+        mb = len(xml) / 1048576.0
+        if t_import is None:
+            import_speed = '%14s' % 'failed'
+        else:
+            import_speed = '%9.1f MB/s' % (mb / t_import)
+        print "%8d %8.1f %9.1f MB/s %9.1f MB/s %s %9.1f MB/s" % (
+            count, mb, mb / t_export, mb / t_to_xml, import_speed,
+            mb / t_to_zexp)
+        transaction.abort()
+        conn.close()
+        db.close()
+        for name in dirname, 'original', 'stock', 'streamed':
+            if os.path.exists(os.path.join(tmpdir, name)):
+                shutil.rmtree(os.path.join(tmpdir, name))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] benchmark',
+                                   description='runs a benchmark')
+    parser.add_option('--sizes', action='store', type='str',
+                      default='1000,2000,4000,8000,16000',
+                      help='comma-separated list of object counts')
+    parser.add_option('--file-size', action='store', type='int',
+                      default=10000,
+                      help='size of the files of the storage benchmark')
+    opts, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in benchmark_registry:
+        parser.print_help()
+        print
+        print "Benchmarks:"
+        for name, fn in sorted(benchmark_registry.items()):
+            print "  %-12s %s" % (name, fn.__doc__)
+        sys.exit()
+    opts.sizes = [int(n) for n in opts.sizes.split(',')]
+    tmpdir = tempfile.mkdtemp(prefix='z2bench-')
+    try:
+        benchmark_registry[args[0]](opts, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
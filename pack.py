@@ -13,23 +13,52 @@ Licenced under the Zope Public Licence (ZPL) version 2.1.  Find a copy
 in your Zope 2 distribution (without which this script is useless).
 """
 
+import os
 import sys
+import atexit
+import hashlib
+import shutil
+import tempfile
 import optparse
+import multiprocessing
 
 import transaction
 from ZODB.DB import DB
 from ZODB.MappingStorage import MappingStorage
-from OFS import XMLExportImport
+from ZODB.FileStorage import FileStorage
+from ZODB.utils import p64
+from Acquisition import aq_base
+from OFS.Folder import Folder
 
 import z2loader
+import z2writer
+import z2cache
+import zexp
 
 
-def create_memory_storage():
+# ZODB's default number of objects kept in a connection's cache
+DEFAULT_CACHE_SIZE = 400
+
+
+def create_memory_storage(cache_size=DEFAULT_CACHE_SIZE):
     storage = MappingStorage()
-    db = DB(storage)
+    db = DB(storage, cache_size=cache_size)
+    return db
+
+
+def create_file_storage(cache_size=DEFAULT_CACHE_SIZE):
+    # Keeps the data on disk, so large sites don't have to fit in memory
+    tmpdir = tempfile.mkdtemp(prefix='z2scratch-')
+    atexit.register(shutil.rmtree, tmpdir, True)
+    storage = FileStorage(os.path.join(tmpdir, 'Data.fs'))
+    db = DB(storage, cache_size=cache_size)
     return db
 
 
+storage_registry = dict(memory=create_memory_storage,
+                        file=create_file_storage)
+
+
 exporter_registry = {}
 
 
@@ -41,28 +70,286 @@ def exporter(format):
 
 
 @exporter('xml')
-def export_object_to_xml(ob, fp):
-    XMLExportImport.exportXML(ob._p_jar, ob._p_oid, fp)
+def export_records_to_xml(records, fp):
+    zexp.write_xml(records, fp)
 
 
 @exporter('zexp')
-def export_object_to_zexp(ob, fp):
-    ob._p_jar.exportFile(ob._p_oid, fp)
+def export_records_to_zexp(records, fp):
+    zexp.write_records(records, fp)
 
 
-def export_object(ob, fp, format='zexp'):
-    conn = None
-    if ob._p_jar is None:
-        db = create_memory_storage()
-        conn = db.open()
-        conn.root()['stuff'] = ob
-        transaction.commit()
+def export_records(records, fp, format='zexp'):
     exporter = exporter_registry.get(format)
     if not exporter:
         sys.exit('unknown export format: %s' % format)
-    exporter(ob, fp)
-    if conn is not None:
-        conn.close()
+    exporter(records, fp)
+
+
+# Each worker process writes the records of one item of the top-level
+# folder at a time, with oids starting at (task number << OID_SHIFT)
+OID_SHIFT = 40
+
+# Set up by pack_in_parallel() before the worker processes are forked
+worker_settings = {}
+worker_conn = None
+
+
+def pack_item(task):
+    """Load and pickle one item of the top-level folder (in a worker)."""
+    global worker_conn
+    number, filename = task
+    opts = worker_settings['opts']
+    cache = worker_settings['cache']
+    if worker_conn is None:
+        db = storage_registry[opts.storage](opts.zodb_cache_size)
+        worker_conn = db.open()
+    if cache is not None:
+        cache.used = {}
+        cache.hits = cache.misses = 0
+    for key in z2loader.classify_stats:
+        z2loader.classify_stats[key] = 0
+    ob = z2loader.load_object(filename, cache=cache, jar=worker_conn,
+                              reproducible=opts.reproducible,
+                              dedup=opts.dedup)
+    result = None
+    if ob is not None:
+        first_oid = number << OID_SHIFT
+        tmpname = os.path.join(worker_settings['tmpdir'], '%d.zexp' % number)
+        writer = zexp.RecordWriter(worker_conn,
+                                   reproducible=opts.reproducible,
+                                   first_oid=first_oid)
+        f = file(tmpname, 'wb')
+        try:
+            writer.write(ob, f)
+        finally:
+            f.close()
+        result = (ob.__class__, p64(first_oid), tmpname)
+    transaction.abort()
+    worker_conn.cacheMinimize()
+    if cache is not None:
+        cached = (cache.used, cache.hits, cache.misses)
+    else:
+        cached = ({}, 0, 0)
+    return (result, cached, dict(z2loader.classify_stats))
+
+
+def pack_in_parallel(filename, tmpdir, opts, cache=None):
+    """Load and pickle a directory with several worker processes.
+
+    Every item of the directory is loaded and written to a temporary file
+    by a worker.  Returns an iterator over the records of the whole export.
+    """
+    worker_settings.update(opts=opts, cache=cache, tmpdir=tmpdir)
+    context = z2loader.LoadContext(cache=cache,
+                                   reproducible=opts.reproducible)
+    source = z2loader.Source(filename, context)
+    names = source.names()
+    tasks = [(number, os.path.join(filename, name))
+             for number, name in enumerate(names, 1)]
+    pool = multiprocessing.Pool(opts.jobs)
+    try:
+        results = list(pool.imap(pack_item, tasks))
+    finally:
+        pool.terminate()
+    folder = Folder(source.name)
+    writer = zexp.RecordWriter(reproducible=opts.reproducible)
+    items = []
+    tmpnames = []
+    for name, (result, (used, hits, misses), stats) in zip(names, results):
+        if cache is not None:
+            cache.used.update(used)
+            cache.hits += hits
+            cache.misses += misses
+        for key, value in stats.items():
+            z2loader.classify_stats[key] += value
+        if result is None:
+            continue
+        klass, oid, tmpname = result
+        # The worker wrote the real thing; the folder only needs something
+        # of the right class to refer to
+        stand_in = klass.__new__(klass)
+        writer.assign(stand_in, oid)
+        items.append((name, stand_in))
+        tmpnames.append(tmpname)
+    z2loader.classify_stats['directory'] += 1
+    z2loader.populate_folder(folder, items)
+    z2loader.load_metadata(folder, source)
+    return parallel_records(writer.records(folder), tmpnames)
+
+
+def parallel_records(records, tmpnames):
+    for record in records:
+        yield record
+    for tmpname in tmpnames:
+        f = file(tmpname, 'rb')
+        try:
+            for record in zexp.read_records(f):
+                yield record
+        finally:
+            f.close()
+        os.unlink(tmpname)
+
+
+class DigestOutput(z2writer.Output):
+    """Computes MD5 digests of the files z2writer would write."""
+
+    def __init__(self):
+        z2writer.Output.__init__(self)
+        self.digests = {}
+
+    def mkdir(self, dirname):
+        self._dirs.add(dirname)
+        self.digests[dirname] = 'directory'
+
+    def makedirs(self, dirname):
+        self._dirs.add(dirname)
+
+    def write(self, filename, chunks):
+        md5 = hashlib.md5()
+        for chunk in chunks:
+            md5.update(chunk)
+        self.digests[filename] = md5.hexdigest()
+
+
+def object_path(filename):
+    # The path of the object a file written by z2writer belongs to
+    dirname, name = os.path.split(filename)
+    parent, meta = os.path.split(dirname)
+    if meta == '.z2meta':
+        if name == '__this__':
+            return parent
+        return os.path.join(parent, name)
+    return filename
+
+
+def object_digests(digests):
+    """Combine digests of files into a manifest of {path: digest}.
+
+    The exported object itself is left out.
+    """
+    files = {}
+    for filename, digest in digests.items():
+        files.setdefault(object_path(filename), []).append((filename, digest))
+    files.pop('', None)
+    return dict((path, hashlib.md5(repr(sorted(items))).hexdigest())
+                for path, items in files.items())
+
+
+def tree_manifest(ob):
+    """Compute the manifest of a tree of objects."""
+    output = DigestOutput()
+    z2writer.write_object(ob, '', output)
+    return object_digests(output.digests)
+
+
+def export_manifest(filename):
+    """Compute the manifest of an export file."""
+    fp = zexp.open_export(filename)
+    if zexp.strip_compression(filename).endswith('.xml'):
+        converted = tempfile.TemporaryFile()
+        zexp.xml_to_zexp(fp, converted)
+        fp.close()
+        converted.seek(0)
+        fp = converted
+    try:
+        output = DigestOutput()
+        zexp.tree_reader(fp, output).run('')
+    finally:
+        fp.close()
+    return object_digests(output.digests)
+
+
+def is_export(filename):
+    if zexp.compression(filename):
+        return True
+    f = file(filename, 'rb')
+    try:
+        head = f.read(5)
+    finally:
+        f.close()
+    return head.startswith(zexp.MAGIC) or head.startswith('<?xml')
+
+
+def load_manifest(filename):
+    """Load a manifest saved by save_manifest(), or compute it from an
+    export file."""
+    if is_export(filename):
+        return export_manifest(filename)
+    manifest = {}
+    for line in file(filename):
+        digest, path = line.rstrip('\n').split(' ', 1)
+        manifest[path] = digest
+    return manifest
+
+
+def save_manifest(filename, manifest):
+    tmpname = temporary_name(filename)
+    try:
+        f = file(tmpname, 'w')
+        try:
+            for path, digest in sorted(manifest.items()):
+                f.write('%s %s\n' % (digest, path))
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+
+
+def make_delta(ob, manifest, baseline):
+    """Remove everything that is the same as in the baseline from ob.
+
+    Folders are kept if anything inside them changed, but only with the
+    changed items inside.  Returns lists of added, changed and removed
+    paths.
+    """
+    added = sorted(path for path in manifest if path not in baseline)
+    changed = sorted(path for path in manifest
+                     if path in baseline and manifest[path] != baseline[path])
+    removed = sorted(path for path in baseline if path not in manifest)
+    keep = set()
+    for path in added + changed:
+        while path and path not in keep:
+            keep.add(path)
+            path = os.path.dirname(path)
+    if z2writer.is_container(ob):
+        prune(ob, '', keep)
+    return added, changed, removed
+
+
+def prune(folder, path, keep):
+    ids = set()
+    for id in folder.objectIds():
+        child_path = os.path.join(path, id)
+        if child_path not in keep:
+            folder._delOb(id)
+            continue
+        ids.add(id)
+        child = aq_base(folder._getOb(id))
+        if z2writer.is_container(child):
+            prune(child, child_path, keep)
+    folder._objects = tuple(info for info in folder._objects
+                            if info['id'] in ids)
+
+
+def report_delta(added, changed, removed, fp=sys.stderr):
+    for prefix, paths in [('A', added), ('M', changed), ('D', removed)]:
+        for path in paths:
+            print >> fp, prefix, path
+    print >> fp, "%d added, %d changed, %d removed" % (
+        len(added), len(changed), len(removed))
+
+
+def temporary_name(filename):
+    """Pick a name to write filename under until it's complete.
+
+    The name is in the same directory, so it can be renamed into place,
+    and ends the same way, so it gets the same compression.
+    """
+    dirname, name = os.path.split(filename)
+    return os.path.join(dirname, '.tmp%d-%s' % (os.getpid(), name))
 
 
 def main():
@@ -74,28 +361,104 @@ def main():
     parser.add_option('-f', action='store', dest='format', type='str',
                       help='output format (xml or zexp);'
                       ' default is autodetected from output filename')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='report loading statistics')
+    parser.add_option('-j', '--jobs', action='store', type='int', default=1,
+                      help='number of processes to load and pickle the'
+                      ' items of the top-level folder with (with --since,'
+                      ' --manifest or a single file: threads to read files'
+                      ' with)')
+    parser.add_option('--cache', action='store', dest='cache', type='str',
+                      help='keep loaded objects in this file between runs')
+    parser.add_option('--reproducible', action='store_true',
+                      help='produce the same bytes every time for the same'
+                      ' files')
+    parser.add_option('--dedup', action='store_true',
+                      help='store identical large files only once')
+    parser.add_option('--since', action='store', metavar='FILE',
+                      help='include only objects that changed since this'
+                      ' export file or manifest (and the folders they are'
+                      ' in)')
+    parser.add_option('--manifest', action='store', metavar='FILE',
+                      help='save a manifest of all objects for later'
+                      ' --since')
+    parser.add_option('--storage', action='store', type='choice',
+                      choices=sorted(storage_registry), default='memory',
+                      help='where to keep the objects while exporting: memory'
+                      ' or a temporary file (default: %default)')
+    parser.add_option('--zodb-cache-size', action='store', type='int',
+                      default=DEFAULT_CACHE_SIZE,
+                      help='number of objects to keep in memory'
+                      ' (default: %default)')
     opts, args = parser.parse_args()
     if args:
         what = args[0]
     else:
         parser.print_help()
         sys.exit()
-    ob = z2loader.load_object(what)
-    if ob is None:
-        sys.exit('cannot load %s' % what)
+    cache = None
+    if opts.cache:
+        cache = z2cache.LoadCache(opts.cache)
+    conn = None
+    delta = opts.since or opts.manifest
+    if opts.jobs > 1 and os.path.isdir(what) and not delta:
+        tmpdir = tempfile.mkdtemp(prefix='z2pack-')
+        atexit.register(shutil.rmtree, tmpdir, True)
+        records = pack_in_parallel(what, tmpdir, opts, cache)
+    else:
+        # Large files are saved into the database while they're being read
+        db = storage_registry[opts.storage](opts.zodb_cache_size)
+        conn = db.open()
+        ob = z2loader.load_object(what, jobs=opts.jobs, cache=cache,
+                                  jar=conn, reproducible=opts.reproducible,
+                                  dedup=opts.dedup)
+        if ob is None:
+            sys.exit('cannot load %s' % what)
+        # read_pdata() adds chunks to the connection without saving all of
+        # them; RecordWriter copies them from storage
+        transaction.savepoint(optimistic=True)
+        if delta:
+            manifest = tree_manifest(ob)
+            if opts.manifest:
+                save_manifest(opts.manifest, manifest)
+            if opts.since:
+                report_delta(*make_delta(ob, manifest,
+                                         load_manifest(opts.since)))
+        writer = zexp.RecordWriter(conn, reproducible=opts.reproducible)
+        records = writer.records(ob)
+    if cache is not None:
+        cache.save()
+    if opts.verbose:
+        z2loader.report_stats()
+        if cache is not None:
+            cache.report()
     format = opts.format
     if opts.output != '-':
-        where = file(opts.output, 'wb')
+        tmpname = temporary_name(opts.output)
+        try:
+            where = zexp.open_export(tmpname, 'wb')
+        except zexp.FormatError, e:
+            sys.exit(str(e))
         if not format:
-            if opts.output.endswith('.xml'):
+            if zexp.strip_compression(opts.output).endswith('.xml'):
                 format = 'xml'
             else:
                 format = 'zexp'
+        try:
+            export_records(records, where, format)
+            # compressed files are finished when they're closed
+            where.close()
+            os.rename(tmpname, opts.output)
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
     else:
-        where = sys.stdout
         if not format: format = 'xml'
-    export_object(ob, where, format)
-
+        export_records(records, sys.stdout, format)
+    if conn is not None:
+        # Nothing was committed; throw away the savepoint
+        transaction.abort()
+        conn.close()
 
 if __name__ == '__main__':
     main()
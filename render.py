@@ -15,8 +15,12 @@ in your Zope 2 distribution (without which this script is useless).
 
 import os
 import sys
-import optparse
+import time
 import shutil
+import optparse
+import threading
+import traceback
+import multiprocessing
 from cStringIO import StringIO
 
 try:
@@ -31,6 +35,7 @@ from ZPublisher.mapply import mapply
 from ZPublisher.BaseRequest import RequestContainer
 from ZPublisher import HTTPResponse
 from OFS.Application import Application
+from zope.interface import directlyProvides, directlyProvidedBy
 
 try:
     # Zope 2.12
@@ -40,6 +45,9 @@ except ImportError:
     xmlconfig = None
 
 import z2loader
+import z2cache
+import z2deps
+import z2writer
 
 
 try:
@@ -85,23 +93,50 @@ def configure():
         xmlconfig.string('<include package="Products.Five" />')
 
 
+class RenderSession(object):
+    """The parts of the publishing environment shared by all pages.
+
+    The Application, the acquisition wrapper of the root object and the
+    request container are built once per site.  Every page gets a fresh
+    request and response, which take the place of the previous ones in the
+    request container.
+    """
+
+    def __init__(self, root):
+        self.container = RequestContainer(REQUEST=None)
+        self.app = Application().__of__(self.container)
+        self.root = root.__of__(self.app)
+        self.root_path = self.root.getPhysicalPath()
+        self.skin = None
+
+    def new_request(self, output_root='', outputdir=''):
+        environ = {'SERVER_NAME': 'localhost',
+                   'SERVER_PORT': '80'}
+        response = Response(stdout=sys.stdout, stderr=sys.stderr)
+        request = Request(StringIO(), environ, response)
+        if output_root:
+            request['SERVER_URL'] = relpath(output_root, outputdir)
+        # Looking up the default skin is the slow part of setDefaultSkin()
+        if self.skin is None:
+            setDefaultSkin(request)
+            self.skin = directlyProvidedBy(request)
+        else:
+            directlyProvides(request, self.skin)
+        request.other['VirtualRootPhysicalPath'] = self.root_path
+        self.container.REQUEST = request
+        return request, response
+
+
 def render_object(obj, path, where, append_html=True, output_root='',
-                  raise_errors=False):
+                  raise_errors=False, output=None, session=None):
     path = path.strip('/')
     assert '..' not in path
     outputfile = os.path.join(where, path)
     outputdir = os.path.dirname(outputfile)
-    environ = {'SERVER_NAME': 'localhost',
-               'SERVER_PORT': '80'}
-    stdin = StringIO()
-    response = Response(stdout=sys.stdout, stderr=sys.stderr)
-    request = Request(stdin, environ, response)
-    if output_root:
-        request['SERVER_URL'] = relpath(output_root, outputdir)
-    setDefaultSkin(request)
-    app = Application().__of__(RequestContainer(REQUEST=request))
-    obj = obj.__of__(app)
-    request.other['VirtualRootPhysicalPath'] = obj.getPhysicalPath()
+    if session is None:
+        session = RenderSession(obj)
+    request, response = session.new_request(output_root, outputdir)
+    obj = session.root
     obj = obj.unrestrictedTraverse(path)
     if getattr(obj, 'index_html', None) is not None:
         obj = obj.index_html
@@ -136,42 +171,153 @@ def render_object(obj, path, where, append_html=True, output_root='',
             html_response = (content_type == 'text/html')
             if not outputfile.endswith('.html') and html_response and append_html:
                 outputfile += '.html'
-            if not os.path.isdir(outputdir):
-                os.makedirs(outputdir)
-            print >> file(outputfile, 'w'), result
+            if output is None:
+                output = z2writer.Output()
+            output.makedirs(outputdir)
+            output.write(outputfile, [result, '\n'])
+
+
+def list_pages(folder, path='',
+               object_types=['Page Template', 'File', 'Image'],
+               folder_types=['Folder']):
+    """Find the folders and pages of a folder tree.
+
+    Returns two lists of paths relative to the root of the site.
+    """
+    names = folder.objectIds(object_types)
+    if 'index_html' not in names:
+        names.append('index_html')
+    folders = [path]
+    pages = [z2deps.child_path(path, name) for name in names]
+    for name in folder.objectIds(folder_types):
+        subfolders, subpages = list_pages(folder._getOb(name),
+                                          z2deps.child_path(path, name),
+                                          object_types=object_types,
+                                          folder_types=folder_types)
+        folders.extend(subfolders)
+        pages.extend(subpages)
+    return folders, pages
+
+
+def make_folder(where, path):
+    outputdir = os.path.join(where, path)
+    os.makedirs(outputdir)
+    os.symlink('index_html', os.path.join(outputdir, 'index.html'))
+
+
+def folder_pages(session, path, where,
+                 object_types=['Page Template', 'File', 'Image'],
+                 folder_types=['Folder']):
+    """Create the directories and index.html symlinks of a folder tree.
+
+    Returns the paths of all the pages to render into them.
+    """
+    path = path.strip('/')
+    assert '..' not in path
+    folder = session.root.unrestrictedTraverse(path)
+    folders, pages = list_pages(folder, path,
+                                object_types=object_types,
+                                folder_types=folder_types)
+    for dirpath in folders:
+        make_folder(where, dirpath)
+    return pages
 
 
 def render_folder(root, path, where,
                   object_types=['Page Template', 'File', 'Image'],
                   folder_types=['Folder'],
                   output_root=None,
-                  raise_errors=False):
-    path = path.strip('/')
-    assert '..' not in path
-    outputdir = os.path.join(where, path)
-    os.makedirs(outputdir)
+                  raise_errors=False,
+                  output=None,
+                  session=None,
+                  jobs=1,
+                  deps=None):
     if output_root is None:
         output_root = where
-    app = Application()
-    obj = root.__of__(app)
-    folder = obj.unrestrictedTraverse(path)
-    names = folder.objectIds(object_types)
-    if 'index_html' not in names:
-        names.append('index_html')
-    for name in names:
-        render_object(root, path + '/' + name, where,
+    if session is None:
+        session = RenderSession(root)
+    pages = folder_pages(session, path, where,
+                         object_types=object_types,
+                         folder_types=folder_types)
+    if deps is not None:
+        pages = [page for page in pages if not deps.reuse(page, where)]
+    if jobs > 1:
+        render_in_parallel(pages, jobs, root=root, where=where,
+                           output_root=output_root,
+                           raise_errors=raise_errors,
+                           output=output, session=session, deps=deps)
+        return
+    for page in pages:
+        if deps is not None:
+            deps.start()
+        render_object(root, page, where,
                       append_html=False, output_root=output_root,
-                      raise_errors=raise_errors)
-    os.symlink('index_html', os.path.join(outputdir, 'index.html'))
+                      raise_errors=raise_errors, output=output,
+                      session=session)
+        if deps is not None:
+            deps.record(page, where, deps.stop())
 
-    names = folder.objectIds(folder_types)
-    for name in names:
-        render_folder(root, path + '/' + name,
-                      where,
-                      object_types=object_types,
-                      folder_types=folder_types,
-                      output_root=output_root,
-                      raise_errors=raise_errors)
+
+# Number of pages handed to a worker process at a time
+PAGES_PER_TASK = 8
+
+# Set up by render_in_parallel() before the worker processes are forked
+worker_settings = {}
+
+
+def render_page(path):
+    """Render one page (in a worker).
+
+    Returns whatever render_object() printed to stderr, so the parent can
+    print it in the same order as a serial run would, whether it raised an
+    exception (a traceback of which is part of the output), and the paths
+    of the objects the page depends on if dependencies are being tracked.
+    """
+    settings = worker_settings
+    deps = settings['deps']
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        if deps is not None:
+            deps.start()
+        try:
+            render_object(settings['root'], path, settings['where'],
+                          append_html=False,
+                          output_root=settings['output_root'],
+                          raise_errors=settings['raise_errors'],
+                          output=settings['output'],
+                          session=settings['session'])
+        except Exception:
+            traceback.print_exc()
+            return sys.stderr.getvalue(), True, None
+        if deps is not None:
+            return sys.stderr.getvalue(), False, deps.stop()
+        return sys.stderr.getvalue(), False, None
+    finally:
+        sys.stderr = stderr
+
+
+def render_in_parallel(pages, jobs, **settings):
+    """Render pages with several worker processes.
+
+    The workers are forked with the loaded tree and the Zope configuration
+    already in memory, so they don't need to load anything themselves.
+    """
+    worker_settings.update(settings)
+    deps = settings['deps']
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.imap(render_page, pages, PAGES_PER_TASK)
+        for page, (errors, failed, paths) in zip(pages, results):
+            sys.stderr.write(errors)
+            if failed:
+                sys.exit(1)
+            if deps is not None:
+                deps.record(page, settings['where'], paths)
+    finally:
+        pool.terminate()
 
 
 def serve_folder(dir):
@@ -183,6 +329,74 @@ def serve_folder(dir):
     httpd.serve_forever()
 
 
+# Seconds between looking for changed files in --watch mode
+WATCH_INTERVAL = 0.5
+
+
+def watch(root, source, where, deps, session, raise_errors=False,
+          save_deps=False):
+    """Render pages again whenever the files they were made from change.
+
+    Runs until interrupted.  ``source`` is the directory the site was
+    loaded from and ``where`` the directory it was rendered to, with
+    ``deps`` tracking dependencies.  Changed files are loaded into the
+    site in memory again, and then only the pages that depend on them, new
+    pages and pages that failed last time are rendered again, in place.
+    """
+    folders, pages = list_pages(session.root)
+    mtimes = z2deps.scan_mtimes(source)
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        new_mtimes = z2deps.scan_mtimes(source)
+        if new_mtimes == mtimes:
+            continue
+        start = time.time()
+        paths = z2deps.changed_sources(source, mtimes, new_mtimes)
+        mtimes = new_mtimes
+        signatures = z2deps.update_signatures(source, deps.signatures,
+                                              paths)
+        changed = z2deps.changed_paths(deps.signatures, signatures)
+        if not changed:
+            continue
+        z2deps.update_tree(root, source, deps.signatures, signatures)
+        deps.signatures = signatures
+        deps.track(root)
+        old_folders, old_pages = set(folders), set(pages)
+        folders, pages = list_pages(session.root)
+        for page in old_pages.difference(pages):
+            deps.pages.pop(page, None)
+            filename = os.path.join(where, page)
+            if os.path.lexists(filename):
+                os.unlink(filename)
+        for dirpath in sorted(old_folders.difference(folders), reverse=True):
+            shutil.rmtree(os.path.join(where, dirpath), True)
+        for dirpath in folders:
+            if dirpath not in old_folders:
+                make_folder(where, dirpath)
+        todo = set(deps.dependents(changed))
+        todo.update(page for page in pages if page not in deps.pages)
+        output = z2writer.Output()
+        for page in pages:
+            if page not in todo:
+                continue
+            # If it fails now, a clean render wouldn't have it either
+            filename = os.path.join(where, page)
+            if os.path.lexists(filename):
+                os.unlink(filename)
+            deps.start()
+            render_object(root, page, where,
+                          append_html=False, output_root=where,
+                          raise_errors=raise_errors, output=output,
+                          session=session)
+            deps.record(page, where, deps.stop())
+        output.close()
+        print "%d objects changed, %d pages rendered in %.3fs" % (
+            len(changed), len(todo), time.time() - start)
+        sys.stdout.flush()
+        if save_deps:
+            deps.save(where)
+
+
 def main():
     parser = optparse.OptionParser(usage='%prog [options] directory [object ...]',
                                    description='renders Zope 2 page templates'
@@ -197,30 +411,108 @@ def main():
                       help='spawn pdb on errors')
     parser.add_option('--serve', action='store_true',
                       help='serve the results over http')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='report loading statistics')
+    parser.add_option('-j', '--jobs', action='store', type='int', default=1,
+                      help='number of threads to read files with and of'
+                      ' processes to render pages with')
+    parser.add_option('--cache', action='store', dest='cache', type='str',
+                      help='keep loaded objects in this file between runs')
+    parser.add_option('--compile-cache', action='store', type='str',
+                      metavar='DIR',
+                      help='keep compiled templates and scripts in this'
+                      ' directory between runs')
+    parser.add_option('--incremental', action='store_true',
+                      help='render only pages whose sources changed since'
+                      ' the last --incremental run into the output directory')
+    parser.add_option('--watch', action='store_true',
+                      help='keep rendering pages again as their sources'
+                      ' change (use with --serve)')
     opts, args = parser.parse_args()
     if len(args) < 1:
         parser.print_help()
         sys.exit()
     what = args.pop(0)
-    ob = z2loader.load_object(what)
+    cache = None
+    if opts.cache:
+        cache = z2cache.LoadCache(opts.cache)
+    signatures = None
+    if opts.incremental or opts.watch:
+        # Before loading, so that changes made meanwhile are seen next time
+        signatures = z2deps.tree_signatures(what)
+    compile_cache = None
+    if opts.compile_cache:
+        compile_cache = z2cache.CompileCache(opts.compile_cache)
+    ob = z2loader.load_object(what, jobs=opts.jobs, cache=cache,
+                              compile_cache=compile_cache)
     if ob is None:
         sys.exit('cannot load %s' % what)
+    if cache is not None:
+        cache.save()
+    if compile_cache is not None:
+        compile_cache.prune()
+    if opts.verbose:
+        z2loader.report_stats()
+        if cache is not None:
+            cache.report()
+        if compile_cache is not None:
+            compile_cache.report()
     if opts.pdb:
         opts.debug = True
+        # pdb needs to run in this process
+        opts.jobs = 1
     try:
         configure()
+        session = RenderSession(ob)
         if not args and opts.output == '-':
             args = ob.objectIds('Page Template')
+        if args and opts.watch:
+            sys.exit('--watch renders the whole site, not single objects')
         if args:
             for what in args:
                 render_object(ob, what, opts.output,
-                              raise_errors=opts.debug)
+                              raise_errors=opts.debug, session=session)
         else:
-            if opts.overwrite and os.path.exists(opts.output):
-                shutil.rmtree(opts.output)
-            render_folder(ob, '', opts.output,
-                          raise_errors=opts.debug)
-            if opts.serve:
+            if (os.path.lexists(opts.output)
+                    and not (opts.overwrite or opts.incremental)):
+                sys.exit('%s already exists (use --overwrite)' % opts.output)
+            # Render next to the old tree and swap them when we're done, so
+            # whoever's serving it never sees a half-written tree
+            staged = z2writer.start_staging(opts.output)
+            try:
+                output = z2writer.Output(root=staged, previous=opts.output,
+                                         destination=opts.output)
+                deps = previous = None
+                if opts.incremental:
+                    previous = z2deps.load_dependencies(opts.output)
+                if opts.incremental or opts.watch:
+                    deps = z2deps.Dependencies(signatures, previous,
+                                               opts.output)
+                    deps.track(ob)
+                render_folder(ob, '', staged,
+                              raise_errors=opts.debug,
+                              output=output, session=session,
+                              jobs=opts.jobs, deps=deps)
+                if opts.incremental:
+                    deps.save(staged, output)
+                if deps is not None and opts.verbose:
+                    deps.report()
+                output.close()
+                z2writer.finish_staging(staged, opts.output)
+            finally:
+                z2writer.abort_staging(staged)
+            if opts.watch:
+                # serve_folder() changes the working directory
+                source = os.path.abspath(what)
+                where = os.path.abspath(opts.output)
+                if opts.serve:
+                    thread = threading.Thread(target=serve_folder,
+                                              args=(where,))
+                    thread.setDaemon(True)
+                    thread.start()
+                watch(ob, source, where, deps, session,
+                      raise_errors=opts.debug, save_deps=opts.incremental)
+            elif opts.serve:
                 serve_folder(opts.output)
     except KeyboardInterrupt:
         print
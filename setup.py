@@ -7,7 +7,8 @@ setup(
     maintainer_email='marius@pov.lt',
     description='Tools to work with a Zope 2 website',
     license='proprietary',
-    py_modules=['unpack', 'z2writer', 'z2loader', 'pack', 'render'],
+    py_modules=['unpack', 'z2writer', 'z2loader', 'z2cache', 'z2deps', 'zexp',
+                'pack', 'render'],
     zip_safe=False,
     install_requires=['Zope2'],
     entry_points=dict(
@@ -15,6 +16,7 @@ setup(
         unpack-zexp = unpack:main
         pack-zexp = pack:main
         render = render:main
+        zexp-index = zexp:main
         """,
     ),
 )
@@ -16,16 +16,22 @@ in your Zope 2 distribution (without which this script is useless).
 
 import os
 import sys
-import optparse
+import atexit
 import shutil
+import tempfile
+import optparse
 
 from ZODB.DB import DB
 from ZODB.MappingStorage import MappingStorage
-from OFS import XMLExportImport
+from ZODB.FileStorage import FileStorage
 
 import z2writer
+import zexp
 
 
+# ZODB's default number of objects kept in a connection's cache
+DEFAULT_CACHE_SIZE = 400
+
 importer_registry = {}
 
 
@@ -38,24 +44,75 @@ def importer(format):
 
 @importer('xml')
 def import_object_from_xml(where, fp):
-    return XMLExportImport.importXML(where._p_jar, fp)
+    return where._p_jar.importFile(xml_to_tempfile(fp))
 
 
 @importer('zexp')
 def import_object_from_zexp(where, fp):
+    if not zexp.is_seekable(fp):
+        fp = zexp.PushbackReader(fp)
     return where._p_jar.importFile(fp)
 
 
-def create_memory_storage():
+def xml_to_tempfile(fp):
+    # Much like OFS.XMLExportImport.importXML(), without reading the
+    # whole XML file into memory
+    converted = tempfile.TemporaryFile()
+    zexp.xml_to_zexp(fp, converted)
+    converted.seek(0)
+    return converted
+
+
+def open_zexp(filename, format='zexp', seekable=False):
+    """Open an export file for reading records, converting XML to zexp.
+
+    Compressed files are decompressed as they are read, unless you need
+    to seek around in them, in which case they're decompressed into a
+    temporary file first.
+    """
+    if format not in ('zexp', 'xml'):
+        sys.exit('unknown export format: %s' % format)
+    try:
+        fp = zexp.open_export(filename)
+    except zexp.FormatError, e:
+        sys.exit(str(e))
+    if format == 'zexp' and not (seekable and zexp.compression(filename)):
+        return fp
+    try:
+        if format == 'xml':
+            return xml_to_tempfile(fp)
+        decompressed = tempfile.TemporaryFile()
+        shutil.copyfileobj(fp, decompressed, zexp.CHUNK_SIZE)
+        decompressed.seek(0)
+        return decompressed
+    finally:
+        fp.close()
+
+
+def create_memory_storage(cache_size=DEFAULT_CACHE_SIZE):
     storage = MappingStorage()
-    db = DB(storage)
+    db = DB(storage, cache_size=cache_size)
+    return db
+
+
+def create_file_storage(cache_size=DEFAULT_CACHE_SIZE):
+    # Keeps the data on disk, so large sites don't have to fit in memory
+    tmpdir = tempfile.mkdtemp(prefix='z2scratch-')
+    atexit.register(shutil.rmtree, tmpdir, True)
+    storage = FileStorage(os.path.join(tmpdir, 'Data.fs'))
+    db = DB(storage, cache_size=cache_size)
     return db
 
 
-def import_object(fp, format='zexp', where=None):
+storage_registry = dict(memory=create_memory_storage,
+                        file=create_file_storage)
+
+
+def import_object(fp, format='zexp', where=None, storage='memory',
+                  cache_size=DEFAULT_CACHE_SIZE):
     conn = None
     if where is None:
-        db = create_memory_storage()
+        db = storage_registry[storage](cache_size)
         conn = db.open()
         where = conn.root()
     importer = importer_registry.get(format)
@@ -65,6 +122,84 @@ def import_object(fp, format='zexp', where=None):
     return ob
 
 
+def stream_object(fp, where, output):
+    """Unpack a zexp file without importing all of it into a database."""
+    zexp.tree_reader(fp, output).run(where)
+
+
+def find_subtrees(fp, paths, index=None):
+    """Locate objects in a zexp file.
+
+    Uses the index, if there is one, and otherwise scans the file.
+
+    Returns the list of oids in file order, a dict of record offsets, and
+    a list of (path, oid).
+    """
+    if index is not None:
+        order, offsets = index.order, index.offsets
+    else:
+        order, offsets = zexp.scan_records(fp)
+    if not order:
+        sys.exit('export file is empty')
+    subtrees = []
+    for path in paths:
+        path = path.strip('/')
+        if not path:
+            sys.exit('--only needs a path inside the exported object')
+        try:
+            if index is not None:
+                oid = index.lookup(path)
+            else:
+                oid = zexp.find_subobject(fp, offsets, order[0], path)
+        except KeyError:
+            sys.exit('%s not found in the export' % path)
+        subtrees.append((path, oid))
+    return order, offsets, subtrees
+
+
+def stream_subtrees(fp, order, offsets, subtrees, where, output):
+    """Unpack some objects out of a zexp file into where/path.
+
+    Reads only the records of the objects and what they refer to.
+    """
+    if not output.isdir(where):
+        output.mkdir(where)
+    for path, oid in subtrees:
+        dirname = where
+        for name in path.split('/')[:-1]:
+            dirname = os.path.join(dirname, name)
+            if not output.isdir(dirname):
+                output.mkdir(dirname)
+        reader = zexp.tree_reader(fp, output)
+        reader.offsets = offsets
+        reader.run(os.path.join(where, path),
+                   zexp.subtree_records(fp, offsets, order, oid))
+
+
+def write_tree(write, where, opts):
+    """Call write(filename, output) to (re)create the tree at where."""
+    if opts.sync:
+        output = z2writer.Output(metadata_index=opts.metadata_index,
+                                 jobs=opts.jobs, verbose=opts.verbose,
+                                 sync=True, root=where)
+        write(where, output)
+        output.close()
+    else:
+        # Build the new tree next to the old one and swap them when it's
+        # done, so nobody sees a half-written tree
+        staged = z2writer.start_staging(where)
+        try:
+            output = z2writer.Output(metadata_index=opts.metadata_index,
+                                     jobs=opts.jobs, verbose=opts.verbose,
+                                     root=staged, previous=where,
+                                     destination=where)
+            write(staged, output)
+            output.close()
+            z2writer.finish_staging(staged, where)
+        finally:
+            z2writer.abort_staging(staged)
+
+
 def main():
     parser = optparse.OptionParser(usage='%prog [options] file.zexp|file.xml [output-directory]',
                                    description='unpacks a Zope 2 export file'
@@ -73,27 +208,73 @@ def main():
                       help='input format (xml or zexp);'
                       ' default is autodetected from filename')
     parser.add_option('--overwrite', action='store_true',
-                      help='overwrite output file/directory tree')
+                      help='replace output file/directory tree')
+    parser.add_option('--sync', action='store_true',
+                      help='update an existing output tree, rewriting only'
+                      ' files that changed')
+    parser.add_option('--metadata-index', action='store_true',
+                      help='store properties of all objects in a directory'
+                      ' in a single .z2meta/__index__ file')
+    parser.add_option('-j', '--jobs', action='store', type='int', default=1,
+                      help='number of threads to write files with')
+    parser.add_option('-v', '--verbose', action='store_true',
+                      help='report the size of every file written')
+    parser.add_option('--storage', action='store', type='choice',
+                      choices=sorted(storage_registry), default='memory',
+                      help='where to keep the imported objects: memory or a'
+                      ' temporary file (default: %default)')
+    parser.add_option('--zodb-cache-size', action='store', type='int',
+                      default=DEFAULT_CACHE_SIZE,
+                      help='number of objects to keep in memory'
+                      ' (default: %default)')
+    parser.add_option('--stream', action='store_true',
+                      help='write objects as they are read instead of'
+                      ' importing the whole export first')
+    parser.add_option('--only', action='append', metavar='PATH',
+                      help='unpack only this object or folder (can be given'
+                      ' more than once)')
     opts, args = parser.parse_args()
     if args:
         what = args[0]
         try:
             where = args[1]
         except IndexError:
-            where = os.path.splitext(what)[0]
+            where = os.path.splitext(zexp.strip_compression(what))[0]
     else:
         parser.print_help()
         sys.exit()
     format = opts.format
     if not format:
-        if what.endswith('.xml'):
+        if zexp.strip_compression(what).endswith('.xml'):
             format = 'xml'
         else:
             format = 'zexp'
-    ob = import_object(file(what, 'rb'), format)
-    if opts.overwrite and os.path.exists(where):
-        shutil.rmtree(where)
-    z2writer.write_object(ob, where)
+    if os.path.lexists(where) and not (opts.overwrite or opts.sync):
+        sys.exit('%s already exists (use --overwrite or --sync)' % where)
+    if opts.only:
+        fp = open_zexp(what, format, seekable=True)
+        index = None
+        if format == 'zexp':
+            # made by zexp-index
+            index = zexp.load_index(what)
+        order, offsets, subtrees = find_subtrees(fp, opts.only, index)
+        def write(filename, output):
+            stream_subtrees(fp, order, offsets, subtrees, filename, output)
+    elif opts.stream:
+        # StreamReader needs to seek to keep memory use bounded
+        fp = open_zexp(what, format, seekable=True)
+        def write(filename, output):
+            stream_object(fp, filename, output)
+    else:
+        try:
+            fp = zexp.open_export(what)
+        except zexp.FormatError, e:
+            sys.exit(str(e))
+        ob = import_object(fp, format, storage=opts.storage,
+                           cache_size=opts.zodb_cache_size)
+        def write(filename, output):
+            z2writer.write_object(ob, filename, output)
+    write_tree(write, where, opts)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,260 @@
+"""
+Keeps Zope 2 objects built by z2loader on disk between runs.
+
+Usage:
+
+    cache = LoadCache('site.z2cache')
+    ob = z2loader.load_object('directory', cache=cache)
+    cache.save()
+
+Objects are stored as pickles keyed by file name.  An entry is reused if
+the file still has the same size and either the same mtime or the same
+MD5 digest of its contents.  Folders are cheap to build and are always
+rebuilt, reusing the cached objects of all unchanged files inside them.
+Files over a megabyte are not cached.
+
+CompileCache keeps compiled Python Script code and cooked Page Template
+programs in a directory, one file per entry, so that templates and scripts
+that were not edited are not compiled again:
+
+    compile_cache = CompileCache('site.z2compiled')
+    ob = z2loader.load_object('directory', compile_cache=compile_cache)
+    compile_cache.prune()
+
+Entries are keyed by a hash of the source and everything else that goes
+into compiling it, including the Zope and Python versions.  prune() removes
+the least recently used entries once the directory gets too large.
+
+Licenced under the Zope Public Licence (ZPL) version 2.1.  Find a copy
+in your Zope 2 distribution (without which this script is useless).
+"""
+
+import os
+import sys
+import types
+import cPickle
+import marshal
+import hashlib
+from cStringIO import StringIO
+
+
+CACHE_VERSION = 1
+
+# Larger files are cheaper to read again than to unpickle, and would bloat
+# the cache
+MAX_FILE_SIZE = 1 << 20
+
+COMPILE_CACHE_VERSION = 2
+
+# Default size limit of a CompileCache directory
+MAX_COMPILE_CACHE_SIZE = 64 << 20
+
+
+class LoadCache(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.used = {}
+        self.hits = self.misses = 0
+        if os.path.exists(filename):
+            self.load()
+
+    def load(self):
+        f = file(self.filename, 'rb')
+        try:
+            try:
+                version, entries = cPickle.load(f)
+            except Exception, e:
+                print >> sys.stderr, "ignoring broken cache %s: %s: %s" % (
+                    self.filename, e.__class__.__name__, e)
+                return
+        finally:
+            f.close()
+        if version == CACHE_VERSION:
+            self.entries = entries
+
+    def key(self, source):
+        return os.path.abspath(source.filename)
+
+    def get(self, source):
+        key = self.key(source)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] != source.size:
+            self.misses += 1
+            return None
+        mtime, size, digest, data = entry
+        if mtime != source.mtime:
+            if digest != source.digest():
+                self.misses += 1
+                return None
+            entry = (source.mtime, size, digest, data)
+        self.used[key] = entry
+        self.hits += 1
+        return cPickle.loads(data)
+
+    def put(self, source, ob):
+        if source.size > MAX_FILE_SIZE:
+            return
+        try:
+            data = cPickle.dumps(ob, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return
+        self.used[self.key(source)] = (source.mtime, source.size,
+                                       source.digest(), data)
+
+    def save(self):
+        # Entries for files that were not seen during this run are dropped
+        tmpname = self.filename + '.tmp'
+        f = file(tmpname, 'wb')
+        try:
+            cPickle.dump((CACHE_VERSION, self.used), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmpname, self.filename)
+
+    def report(self, fp=sys.stderr):
+        print >> fp, "cache: %d hits, %d misses" % (self.hits, self.misses)
+
+
+def zope_version():
+    try:
+        from App.version_txt import version_txt
+    except ImportError:
+        return None
+    return version_txt()
+
+
+def dumps(ob, shared=(), sources=None):
+    """Pickle ob, which may contain code objects.
+
+    Objects listed in ``shared`` (e.g. the TALES engine) are not pickled,
+    only referred to; pass the same list to loads().
+
+    ``sources`` maps id()s of compiled expressions (which often can't be
+    pickled) to their source text.  Only the text is pickled; loads()
+    passes it to ``compile`` to get the expression back.
+    """
+    f = StringIO()
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    positions = dict((id(s), n) for n, s in enumerate(shared))
+    if sources is None:
+        sources = {}
+    def persistent_id(ob):
+        if isinstance(ob, types.CodeType):
+            return 'c' + marshal.dumps(ob)
+        n = positions.get(id(ob))
+        if n is not None:
+            return 's%d' % n
+        text = sources.get(id(ob))
+        if text is not None:
+            return ('e', text)
+        return None
+    pickler.persistent_id = persistent_id
+    pickler.dump(ob)
+    return f.getvalue()
+
+
+def loads(data, shared=(), compile=None):
+    unpickler = cPickle.Unpickler(StringIO(data))
+    compiled = {}
+    def persistent_load(pid):
+        if isinstance(pid, tuple):
+            text = pid[1]
+            if text not in compiled:
+                compiled[text] = compile(text)
+            return compiled[text]
+        if pid.startswith('c'):
+            return marshal.loads(pid[1:])
+        return shared[int(pid[1:])]
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
+class CompileCache(object):
+
+    def __init__(self, dirname, max_size=MAX_COMPILE_CACHE_SIZE):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        # entries that could not be pickled, with the last reason why
+        self.failures = 0
+        self.last_failure = None
+        self.salt = repr((COMPILE_CACHE_VERSION, sys.version, zope_version()))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    def key(self, *args):
+        return hashlib.sha1(self.salt + repr(args)).hexdigest()
+
+    def get(self, key, shared=(), compile=None):
+        filename = os.path.join(self.dirname, key)
+        try:
+            f = file(filename, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            try:
+                ob = loads(f.read(), shared, compile)
+            except Exception, e:
+                print >> sys.stderr, ("ignoring broken cache entry %s: %s: %s"
+                                      % (filename, e.__class__.__name__, e))
+                self.misses += 1
+                return None
+        finally:
+            f.close()
+        try:
+            # prune() goes by mtime
+            os.utime(filename, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return ob
+
+    def put(self, key, ob, shared=(), sources=None):
+        try:
+            data = dumps(ob, shared, sources)
+        except (cPickle.PicklingError, TypeError, ValueError), e:
+            self.failures += 1
+            self.last_failure = '%s: %s' % (e.__class__.__name__, e)
+            return
+        filename = os.path.join(self.dirname, key)
+        # Several processes may share the directory
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        f = file(tmpname, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmpname, filename)
+
+    def prune(self):
+        """Remove least recently used entries until the cache fits max_size."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.dirname):
+            filename = os.path.join(self.dirname, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, filename in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def report(self, fp=sys.stderr):
+        print >> fp, "compile cache: %d hits, %d misses" % (self.hits,
+                                                           self.misses)
+        if self.failures:
+            print >> fp, ("compile cache: %d entries could not be stored"
+                          " (%s)" % (self.failures, self.last_failure))
@@ -0,0 +1,395 @@
+"""
+Keeps track of what the pages rendered by render.py depend on.
+
+Usage:
+
+    signatures = tree_signatures('directory')
+    ob = z2loader.load_object('directory')
+    deps = Dependencies(signatures, load_dependencies('outdir'), 'outdir')
+    deps.track(ob)
+    for page in pages:
+        if not deps.reuse(page, 'newdir'):
+            deps.start()
+            render_object(ob, page, 'newdir')
+            deps.record(page, 'newdir', deps.stop())
+    deps.save('newdir')
+
+While a page is being rendered, every object of the site that gets wrapped
+in an acquisition context is noted down.  Zope does that whenever it looks
+an object up, be it during traversal, acquisition, macro expansion or in
+objectValues().  A page is rendered again when the file or the properties
+of any of these objects change, or when the list of items of any of these
+folders changes (a new item may be acquired instead of an old one).
+
+To follow changes made while the site stays loaded, compare scan_mtimes()
+of the source tree every now and then, and pass the paths changed_sources()
+finds to update_signatures() and then update_tree().
+
+Licenced under the Zope Public Licence (ZPL) version 2.1.  Find a copy
+in your Zope 2 distribution (without which this script is useless).
+"""
+
+import os
+import sys
+import stat
+import shutil
+import cPickle
+
+from Acquisition import aq_base
+
+import z2loader
+import z2writer
+import z2cache
+
+
+DEPS_VERSION = 1
+
+# Saved in the root of the rendered tree
+DEPS_FILE = '.z2deps'
+
+
+def child_path(path, name):
+    if path:
+        return path + '/' + name
+    return name
+
+
+def signature(source):
+    if source.isdir:
+        state = sorted(source.names())
+    else:
+        state = (source.size, source.mtime)
+    return (source.isdir, state, source.metadata())
+
+
+def tree_signatures(filename):
+    """Describe every file and directory that load_object() would load.
+
+    Returns a dict mapping paths relative to filename to something that
+    changes whenever the object loaded from there might.  Call it before
+    loading, so that changes made while loading are noticed next time.
+    """
+    signatures = {}
+    add_signatures(signatures, z2loader.Source(filename), '')
+    return signatures
+
+
+def add_signatures(signatures, source, path):
+    signatures[path] = signature(source)
+    if source.isdir:
+        for child in source.children():
+            add_signatures(signatures, child, child_path(path, child.name))
+
+
+def remove_signatures(signatures, path):
+    """Forget everything inside path."""
+    prefix = child_path(path, '')
+    for p in signatures.keys():
+        if p.startswith(prefix):
+            del signatures[p]
+
+
+def update_signatures(filename, signatures, paths):
+    """Describe the given paths under filename anew.
+
+    Returns an updated copy of signatures.  Things that were added to or
+    removed from directories are described or forgotten as well.
+    """
+    signatures = dict(signatures)
+    context = z2loader.LoadContext()
+    for path in sorted(paths):
+        old = signatures.pop(path, None)
+        try:
+            source = z2loader.Source(source_filename(filename, path), context)
+        except OSError:
+            remove_signatures(signatures, path)
+            continue
+        new = signatures[path] = signature(source)
+        if old is None or old[0] != new[0]:
+            remove_signatures(signatures, path)
+            if source.isdir:
+                add_signatures(signatures, source, path)
+        elif source.isdir:
+            for name in set(old[1]) - set(new[1]):
+                child = child_path(path, name)
+                signatures.pop(child, None)
+                remove_signatures(signatures, child)
+            for name in set(new[1]) - set(old[1]):
+                child = z2loader.Source(os.path.join(source.filename, name),
+                                        context)
+                add_signatures(signatures, child, child_path(path, name))
+    return signatures
+
+
+def source_filename(filename, path):
+    if not path:
+        return filename
+    return os.path.join(filename, *path.split('/'))
+
+
+def scan_mtimes(filename):
+    """Return {filename: (mtime, size)} for everything under filename.
+
+    That's one stat() per file, which is about as cheap as polling gets.
+    """
+    mtimes = {}
+    def walk(dirname):
+        for name in os.listdir(dirname):
+            filename = os.path.join(dirname, name)
+            try:
+                st = os.lstat(filename)
+            except OSError:
+                continue
+            mtimes[filename] = (st.st_mtime, st.st_size)
+            if stat.S_ISDIR(st.st_mode):
+                walk(filename)
+    if os.path.isdir(filename):
+        walk(filename)
+    return mtimes
+
+
+def changed_sources(filename, old, new):
+    """Find the paths that changes between two scan_mtimes() affect."""
+    paths = set()
+    prefix = os.path.join(filename, '')
+    for name in set(old) | set(new):
+        if old.get(name) == new.get(name) or not name.startswith(prefix):
+            continue
+        parts = name[len(prefix):].split(os.sep)
+        if '.z2meta' in parts[:-1]:
+            n = parts.index('.z2meta')
+            dirpath = '/'.join(parts[:n])
+            meta_name = parts[n + 1]
+            if meta_name == '__this__':
+                paths.add(dirpath)
+            elif meta_name == z2loader.METADATA_INDEX:
+                # properties of everything in that directory
+                paths.add(dirpath)
+                dirname = source_filename(filename, dirpath)
+                if os.path.isdir(dirname):
+                    paths.update(child_path(dirpath, child)
+                                 for child in os.listdir(dirname)
+                                 if not child.startswith('.'))
+            else:
+                paths.add(child_path(dirpath, meta_name))
+        elif not [part for part in parts if part.startswith('.')]:
+            # the directory's list of items may have changed too
+            paths.add('/'.join(parts))
+            paths.add('/'.join(parts[:-1]))
+    return paths
+
+
+def find_object(root, path):
+    ob = root
+    if path:
+        for name in path.split('/'):
+            ob = aq_base(ob._getOb(name))
+    return ob
+
+
+def set_item(folder, name, ob):
+    """Add, replace or (with ob=None) remove an item of a folder."""
+    objects = [info for info in folder._objects if info['id'] != name]
+    if name in folder.objectIds():
+        folder._delOb(name)
+    if ob is not None:
+        folder._setOb(name, ob)
+        objects.append({'id': name,
+                        'meta_type': getattr(ob, 'meta_type', None)})
+    folder._objects = tuple(objects)
+
+
+def update_tree(root, filename, old, new, context=None):
+    """Bring a site loaded from filename up to date with the files.
+
+    ``old`` and ``new`` are tree_signatures() from before and after the
+    changes.  Changed files are loaded again and replace the old objects,
+    so do new files and directories; removed ones are removed.  Changed
+    folder properties are set on the existing folders, but properties
+    that are gone are not removed.
+    """
+    if context is None:
+        context = z2loader.LoadContext()
+    for path in sorted(changed_paths(old, new)):
+        if path not in old or path not in new:
+            # an item of a changed folder, taken care of below
+            continue
+        source = z2loader.Source(source_filename(filename, path), context)
+        if old[path][0] and new[path][0]:
+            folder = find_object(root, path)
+            names = set(folder.objectIds())
+            for name in sorted(set(old[path][1]) - set(new[path][1])):
+                if name in names:
+                    set_item(folder, name, None)
+            for name in sorted(set(new[path][1]) - set(old[path][1])):
+                child = z2loader.Source(os.path.join(source.filename, name),
+                                        context)
+                set_item(folder, name, z2loader.load_source(child))
+            if old[path][2] != new[path][2]:
+                z2loader.load_metadata(folder, source)
+        elif path:
+            parent, name = os.path.split(path)
+            set_item(find_object(root, parent), name,
+                     z2loader.load_source(source))
+
+
+def changed_paths(old, new):
+    changed = set()
+    for path in set(old) | set(new):
+        if old.get(path) != new.get(path):
+            changed.add(path)
+    return changed
+
+
+class Tracker(object):
+    """Notes which objects of a site are looked up.
+
+    Works by replacing __of__ of the classes of all objects in the site.
+    """
+
+    def __init__(self):
+        self.paths = {}
+        self.patched = set()
+        self.current = None
+
+    def track(self, root):
+        self.paths.clear()
+        self._walk(aq_base(root), '')
+
+    def _walk(self, ob, path):
+        self.paths[id(ob)] = path
+        self.patch(ob.__class__)
+        if getattr(ob, 'isPrincipiaFolderish', False):
+            for name, child in ob.objectItems():
+                self._walk(aq_base(child), child_path(path, name))
+
+    def patch(self, klass):
+        original = getattr(klass, '__of__', None)
+        if original is None or klass in self.patched:
+            return
+        touch = self.touch
+        def __of__(ob, parent):
+            touch(ob)
+            return original(ob, parent)
+        klass.__of__ = __of__
+        self.patched.add(klass)
+
+    def touch(self, ob):
+        if self.current is not None:
+            path = self.paths.get(id(aq_base(ob)))
+            if path is not None:
+                self.current.add(path)
+
+    def start(self):
+        # Everything depends on the root, which is looked up only once
+        self.current = set([''])
+
+    def stop(self):
+        paths, self.current = self.current, None
+        return paths
+
+
+class Dependencies(object):
+    """The objects each page of a rendered site was made from.
+
+    ``signatures`` come from tree_signatures() of the site being rendered;
+    ``previous`` is what load_dependencies() returned for the tree rendered
+    last time, at ``previous_root``.
+    """
+
+    def __init__(self, signatures, previous=None, previous_root=None):
+        self.signatures = signatures
+        self.previous = previous
+        self.previous_root = previous_root
+        self.pages = {}
+        self.tracker = Tracker()
+        self.rendered = self.reused = 0
+        if previous is not None:
+            self.changed = changed_paths(previous.signatures, signatures)
+        else:
+            self.changed = set()
+
+    def track(self, root):
+        self.tracker.track(root)
+
+    def start(self):
+        self.tracker.start()
+
+    def stop(self):
+        return self.tracker.stop()
+
+    def record(self, page, where, paths):
+        page = page.strip('/')
+        self.rendered += 1
+        # Pages that failed to render have no output and are tried again
+        # next time
+        if os.path.lexists(os.path.join(where, page)):
+            self.pages[page] = frozenset(paths)
+
+    def reuse(self, page, where):
+        """Link the output of an unchanged page from the previous tree.
+
+        Returns False if the page has to be rendered.
+        """
+        if self.previous is None:
+            return False
+        page = page.strip('/')
+        paths = self.previous.pages.get(page)
+        if paths is None or not self.changed.isdisjoint(paths):
+            return False
+        source = os.path.join(self.previous_root, page)
+        if not os.path.isfile(source) or os.path.islink(source):
+            return False
+        target = os.path.join(where, page)
+        if not z2writer.link_file(source, target):
+            shutil.copyfile(source, target)
+        self.pages[page] = paths
+        self.reused += 1
+        return True
+
+    def dependents(self, paths):
+        """Return the pages that depend on any of the given paths."""
+        paths = set(paths)
+        return [page for page, deps in self.pages.items()
+                if not paths.isdisjoint(deps)]
+
+    def save(self, where, output=None):
+        if output is None:
+            output = z2writer.Output()
+        data = cPickle.dumps((DEPS_VERSION, salt(), self.signatures,
+                              self.pages), cPickle.HIGHEST_PROTOCOL)
+        output.write(os.path.join(where, DEPS_FILE), [data])
+
+    def report(self, fp=sys.stderr):
+        print >> fp, "rendered %d pages, %d unchanged pages reused" % (
+            self.rendered, self.reused)
+
+
+def salt():
+    # Pages rendered by a different Zope may come out differently
+    return (sys.version, z2cache.zope_version())
+
+
+def load_dependencies(where):
+    """Load what Dependencies.save() saved in where.
+
+    Returns None if there's nothing usable there.
+    """
+    filename = os.path.join(where, DEPS_FILE)
+    if not os.path.exists(filename):
+        return None
+    f = file(filename, 'rb')
+    try:
+        try:
+            version, saved_salt, signatures, pages = cPickle.load(f)
+        except Exception, e:
+            print >> sys.stderr, "ignoring broken %s: %s: %s" % (
+                filename, e.__class__.__name__, e)
+            return None
+    finally:
+        f.close()
+    if version != DEPS_VERSION or saved_salt != salt():
+        return None
+    deps = Dependencies(signatures)
+    deps.pages = pages
+    return deps
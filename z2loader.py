@@ -17,9 +17,17 @@ in your Zope 2 distribution (without which this script is useless).
 """
 
 import os
-
+import sys
+import stat
+import hashlib
+import collections
+from multiprocessing.pool import ThreadPool
+
+import transaction
+from Acquisition import aq_base
 from OFS.Folder import Folder
-from OFS.Image import Image, File
+from OFS.Image import Image, File, Pdata
+from OFS.ObjectManager import checkValidId
 from OFS.interfaces import IPropertyManager
 from Products.PageTemplates.ZopePageTemplate import ZopePageTemplate
 from Products.PythonScripts.PythonScript import PythonScript
@@ -27,26 +35,356 @@ from Products.PythonScripts.PythonScript import PythonScript
 
 HIGHEST, HIGH, NORMAL, LOW, LOWEST = range(5)
 loader_registry = []
+extension_registry = {}
+
+# How many files were classified by each method; see report_stats()
+classify_stats = dict(directory=0, extension=0, sniffing=0, cached=0)
+
+# Detectors look at no more than this many bytes from the start of a file
+HEAD_SIZE = 1 << 16
+
+# Files up to this size are read in full by the prefetching threads
+PREFETCH_SIZE = 1 << 20
+
+# File and Image contents are stored in Pdata objects of this size (the same
+# size OFS.Image uses for uploads)
+CHUNK_SIZE = 1 << 16
+
+# When loading into a database connection, this many Pdata chunks are kept
+# in memory before a savepoint writes them out
+SAVEPOINT_CHUNKS = 16
 
+# Properties of all objects in a directory can be stored in a single file
+# .z2meta/__index__, with a [properties <name>] section per object, instead
+# of a .z2meta/<name> file per object.  If the index exists, per-object files
+# in that directory are ignored.
+METADATA_INDEX = '__index__'
 
-def loader(condition, priority=NORMAL):
+
+def loader(condition=None, priority=NORMAL, extensions=()):
     def decorator(fn):
-        loader_registry.append((priority, condition, fn))
-        loader_registry.sort() # a bit wasteful to resort every time
+        for ext in extensions:
+            extension_registry[ext] = fn
+        if condition is not None:
+            loader_registry.append((priority, condition, fn))
+            loader_registry.sort() # a bit wasteful to resort every time
         return fn
     return decorator
 
 
-def load_object(filename):
+class LoadContext(object):
+    """Settings shared by all the Sources of one load_object() call.
+
+    ``pool`` is a thread pool used to read children of directories ahead
+    of time (see Source.prefetch()), at most ``window`` children per
+    directory; ``cache`` is a z2cache.LoadCache;
+    ``jar`` is a ZODB connection that receives the contents of large files
+    as they are read (see read_pdata()); without one, files are loaded
+    into plain strings, which is what rendering needs; ``compile_cache`` is a
+    z2cache.CompileCache for Python Script code and Page Template programs.
+
+    With ``reproducible`` set, loading the same files gives the same
+    objects every time: directories are listed in sorted order and File
+    etags are derived from their contents instead of the current time.
+    With ``dedup`` set, byte-identical large files share a single Pdata
+    chain.
+    """
+
+    def __init__(self, pool=None, cache=None, jar=None, reproducible=False,
+                 dedup=False, compile_cache=None, window=1):
+        self.pool = pool
+        self.window = window
+        self.cache = cache
+        self.jar = jar
+        self.compile_cache = compile_cache
+        self.reproducible = reproducible
+        self.dedup = dedup
+        self.metadata_indexes = {}
+        self.payloads = {}
+        # Pdata chunks added to jar since the last savepoint
+        self.unsaved = []
+
+    def metadata_index(self, dirname):
+        # May be called from several prefetch threads at once; the worst
+        # that can happen is that an index gets parsed twice
+        try:
+            return self.metadata_indexes[dirname]
+        except KeyError:
+            filename = os.path.join(dirname, METADATA_INDEX)
+            text = read_file(filename)
+            if text is not None:
+                index = parse_metadata(text, filename)
+            else:
+                index = None
+            self.metadata_indexes[dirname] = index
+            return index
+
+
+class Source(object):
+    """A file or directory that is about to be loaded.
+
+    The file is stat()ed once and opened at most once; detectors and
+    loaders share the bytes read from its head.
+    """
+
+    def __init__(self, filename, context=None):
+        if context is None:
+            context = LoadContext()
+        self.filename = filename
+        self.context = context
+        self.name = os.path.basename(filename.rstrip(os.path.sep))
+        self.ext = os.path.splitext(self.name)[1]
+        st = os.stat(filename)
+        self.isdir = stat.S_ISDIR(st.st_mode)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self._fp = None
+        self._head = None
+        self._data = None
+        self._names = None
+        self._metadata = None
+        self._digest = None
+
+    @property
+    def head(self):
+        if self._head is None:
+            self._fp = file(self.filename, 'rb')
+            self._head = self._fp.read(HEAD_SIZE)
+        return self._head
+
+    @property
+    def first_line(self):
+        return self.head.split('\n', 1)[0]
+
+    def read(self):
+        if self._data is None:
+            data = self.head
+            if len(data) == HEAD_SIZE:
+                data += self._rest().read()
+            self._data = data
+            self.close()
+        return self._data
+
+    def chunks(self, size=CHUNK_SIZE):
+        if self._data is not None:
+            for pos in range(0, len(self._data), size):
+                yield self._data[pos:pos + size]
+            return
+        md5 = hashlib.md5()
+        head = self.head
+        for pos in range(0, len(head), size):
+            chunk = head[pos:pos + size]
+            md5.update(chunk)
+            yield chunk
+        if len(head) == HEAD_SIZE:
+            fp = self._rest()
+            while True:
+                chunk = fp.read(size)
+                if not chunk:
+                    break
+                md5.update(chunk)
+                yield chunk
+        self.close()
+        self._digest = md5.hexdigest()
+
+    def digest(self):
+        if self._digest is None:
+            if self._data is not None or self.size <= PREFETCH_SIZE:
+                self._digest = hashlib.md5(self.read()).hexdigest()
+            else:
+                for chunk in self.chunks():
+                    pass
+        return self._digest
+
+    def _rest(self):
+        # Returns the file positioned right after the head
+        if self._fp is None:
+            self._fp = file(self.filename, 'rb')
+            self._fp.seek(len(self._head))
+        return self._fp
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def names(self):
+        if self._names is None:
+            self._names = [name for name in os.listdir(self.filename)
+                           if not name.startswith('.')]
+            if self.context.reproducible:
+                self._names.sort()
+        return self._names
+
+    def children(self):
+        names = self.names()
+        pool = self.context.pool
+        if pool is None:
+            return (self._child(name) for name in names)
+        else:
+            return self._prefetch_children(pool, names)
+
+    def _prefetch_children(self, pool, names):
+        # Don't read more than a window ahead of the loader, or the pool
+        # would happily read the whole directory into memory
+        pending = collections.deque()
+        names = iter(names)
+        for name in names:
+            pending.append(pool.apply_async(self._prefetch_child, (name,)))
+            if len(pending) >= self.context.window:
+                break
+        while pending:
+            result = pending.popleft()
+            name = next(names, None)
+            if name is not None:
+                pending.append(pool.apply_async(self._prefetch_child,
+                                                (name,)))
+            yield result.get()
+
+    def _child(self, name):
+        return Source(os.path.join(self.filename, name), self.context)
+
+    def _prefetch_child(self, name):
+        source = self._child(name)
+        source.prefetch()
+        return source
+
+    def prefetch(self):
+        # Called in a worker thread; must not touch any Zope objects
+        if self.isdir:
+            self.names()
+        else:
+            self.head
+            if self.size <= PREFETCH_SIZE:
+                self.read()
+            else:
+                # don't hold on to file descriptors while queued
+                self.close()
+        self.metadata()
+
+    def metadata(self):
+        if self._metadata is None:
+            filename = metadata_filename(self.filename, self.isdir)
+            dirname, name = os.path.split(filename)
+            index = self.context.metadata_index(dirname)
+            if index is not None:
+                props = index.get('properties ' + name, [])
+            else:
+                text = read_file(filename)
+                if text is None:
+                    props = []
+                else:
+                    props = parse_metadata(text, filename).get('properties',
+                                                               [])
+            self._metadata = props
+        return self._metadata
+
+
+def read_file(filename):
+    try:
+        f = file(filename, 'r')
+    except IOError:
+        return None
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def classify(source):
+    if not source.isdir:
+        handler = extension_registry.get(source.ext)
+        if handler is not None:
+            classify_stats['extension'] += 1
+            return handler
     for priority, condition, handler in loader_registry:
-        if condition(filename):
-            obj = handler(filename)
-            load_metadata(obj, filename)
-            return obj
-    print "skipping", filename
+        if condition(source):
+            if source.isdir:
+                classify_stats['directory'] += 1
+            else:
+                classify_stats['sniffing'] += 1
+            return handler
     return None
 
 
+def report_stats(fp=sys.stderr):
+    print >> fp, ("loaded %(directory)d directories, %(extension)d files"
+                  " by extension, %(sniffing)d files by content,"
+                  " %(cached)d files from cache"
+                  % classify_stats)
+
+
+def load_object(filename, jobs=1, cache=None, jar=None, reproducible=False,
+                dedup=False, compile_cache=None):
+    context = LoadContext(cache=cache, jar=jar, reproducible=reproducible,
+                          dedup=dedup, compile_cache=compile_cache)
+    if jobs > 1:
+        context.pool = ThreadPool(jobs)
+        context.window = 2 * jobs
+    try:
+        return load_source(Source(filename, context))
+    finally:
+        if context.pool is not None:
+            context.pool.terminate()
+
+
+def load_source(source):
+    cache = source.context.cache
+    if cache is not None and not source.isdir:
+        obj = cache.get(source)
+        if obj is not None:
+            classify_stats['cached'] += 1
+            cook_cached(obj, source)
+            join_payload(obj, source)
+            share_payload(obj, source)
+            set_etag(obj, source)
+            load_metadata(obj, source)
+            return obj
+    try:
+        handler = classify(source)
+        if handler is None:
+            print "skipping", source.filename
+            return None
+        obj = handler(source)
+        if cache is not None and not source.isdir:
+            # metadata lives in a separate file, so cache the object
+            # before the properties are applied
+            cache.put(source, obj)
+    finally:
+        source.close()
+    share_payload(obj, source)
+    set_etag(obj, source)
+    load_metadata(obj, source)
+    return obj
+
+
+def join_payload(ob, source):
+    # Cache entries written by pack-zexp hold Pdata chains, which can't be
+    # rendered (see read_pdata())
+    if source.context.jar is not None or not isinstance(ob, File):
+        return
+    data = aq_base(ob.data)
+    if isinstance(data, Pdata):
+        ob.data = str(data)
+
+
+def share_payload(ob, source):
+    # Lets identical copies of a large file be exported only once
+    if not source.context.dedup or not isinstance(ob, File):
+        return
+    # ob.data would come in an acquisition wrapper, which can't be pickled
+    data = aq_base(ob.data)
+    if isinstance(data, Pdata):
+        key = (source.size, source.digest())
+        ob.data = source.context.payloads.setdefault(key, data)
+
+
+def set_etag(ob, source):
+    # File.update_data() makes up an etag from the current time
+    if source.context.reproducible and isinstance(ob, File):
+        ob._EtagSupport__etag = 'md5%s' % source.digest()
+
+
 def metadata_filename(filename, isdir=None):
     if isdir is None:
         isdir = os.path.isdir(filename)
@@ -58,21 +396,23 @@ def metadata_filename(filename, isdir=None):
                             os.path.basename(filename))
 
 
-def load_metadata(ob, filename):
-    if not IPropertyManager.providedBy(ob):
-        return
-    filename = metadata_filename(filename)
-    if not os.path.exists(filename):
-        return
-    f = file(filename, 'r')
-    for line in f:
-        line = line.rstrip('\n')
-        if line == '[properties]':
-            break
-    for line in f:
-        line = line.rstrip('\n')
+def parse_metadata(text, filename):
+    """Parse the [properties] sections of a .z2meta file.
+
+    Returns {section_name: [(name, type, value), ...]}.
+    """
+    sections = {}
+    props = None
+    for line in text.split('\n'):
         if line.startswith('['):
-            break
+            section = line.strip().strip('[]')
+            if section.split(' ', 1)[0] == 'properties':
+                props = sections.setdefault(section, [])
+            else:
+                props = None
+            continue
+        if props is None:
+            continue
         if line.startswith('#'):
             continue
         if not line.strip():
@@ -102,75 +442,221 @@ def load_metadata(ob, filename):
         else:
             print "%s: unsupported type: %s" % (filename, type)
             continue
+        props.append((name, type, value))
+    return sections
+
 
+def load_metadata(ob, source):
+    if not IPropertyManager.providedBy(ob):
+        return
+    for name, type, value in source.metadata():
         # TODO: handle selection/multiple selection
         if not ob.hasProperty(name):
             ob.manage_addProperty(name, value, type)
             # XXX: apparently type == 'tokens' also needs special handling
         else:
             setattr(ob, name, value)
-    f.close()
 
 
-@loader(condition=os.path.isdir, priority=HIGHEST)
-def load_folder(subdir):
-    id = os.path.basename(subdir.rstrip(os.path.sep))
-    f = Folder(id)
-    for filename in os.listdir(subdir):
-        if filename.startswith('.'):
-            continue
-        full_name = os.path.join(subdir, filename)
-        obj = load_object(full_name)
+@loader(condition=lambda source: source.isdir, priority=HIGHEST)
+def load_folder(source):
+    f = Folder(source.name)
+    items = []
+    for child in source.children():
+        obj = load_source(child)
         if obj is not None:
-            f._setObject(filename, obj)
+            items.append((child.name, obj))
+    populate_folder(f, items)
     return f
 
 
-def detect_py(filename):
-    first_line = file(filename).readline()
-    return (filename.endswith('.py') or
-            first_line.startswith("## Script (Python)"))
-
-
-@loader(condition=detect_py)
-def load_py(filename):
-    id = os.path.basename(filename)
-    ob = PythonScript(id)
-    ob.write(file(filename).read())
+def populate_folder(folder, items):
+    # Folder._setObject() copies the _objects tuple and scans it for
+    # duplicates on every call, which is quadratic for big folders.  It also
+    # fixes up ownership and sends ObjectAdded events, neither of which means
+    # anything for objects built from files (there is no user and no
+    # subscriber to care).  Ids coming from a directory listing are unique,
+    # so all we need to keep is the id validity check.
+    objects = []
+    for id, ob in items:
+        checkValidId(folder, id)
+        folder._setOb(id, ob)
+        objects.append({'id': id, 'meta_type': getattr(ob, 'meta_type', None)})
+    folder._objects = folder._objects + tuple(objects)
+
+
+def detect_py(source):
+    return source.first_line.startswith("## Script (Python)")
+
+
+@loader(condition=detect_py, extensions=['.py'])
+def load_py(source):
+    ob = PythonScript(source.name)
+    compile_cache = source.context.compile_cache
+    if compile_cache is None:
+        ob.write(source.read())
+        return ob
+    ob._compiler = cached_compiler(ob, compile_cache)
+    try:
+        ob.write(source.read())
+    finally:
+        del ob._compiler
     return ob
 
 
-def detect_pt(filename):
-    first_line = file(filename).readline().lstrip()
-    return (filename.endswith('.pt')
-            or first_line.startswith('<') and first_line[1:2].isalpha()
-            or first_line.startswith('<!'))
+def cached_compiler(ob, compile_cache):
+    """Replacement for PythonScript._compiler() that uses the compile cache."""
+    def compile(*args, **kw):
+        key = compile_cache.key('script', args, sorted(kw.items()))
+        result = compile_cache.get(key)
+        if result is None:
+            result = PythonScript._compiler(ob, *args, **kw)
+            compile_cache.put(key, result)
+        return result
+    return compile
 
 
-@loader(condition=detect_pt)
-def load_pt(filename):
-    id = os.path.basename(filename)
-    return ZopePageTemplate(id,
-                            text=file(filename).read().decode('UTF-8'),
-                            content_type='text/html')
+def detect_pt(source):
+    first_line = source.first_line.lstrip()
+    return (first_line.startswith('<') and first_line[1:2].isalpha()
+            or first_line.startswith('<!'))
 
 
-def detect_image(filename):
-    return (filename.endswith('.gif') or filename.endswith('.png') or
-            filename.endswith('.jpg'))
+@loader(condition=detect_pt, extensions=['.pt'])
+def load_pt(source):
+    compile_cache = source.context.compile_cache
+    if compile_cache is None:
+        return ZopePageTemplate(source.name,
+                                text=source.read().decode('UTF-8'),
+                                content_type='text/html')
+    # The template is cooked by __init__, so hook in before calling it
+    ob = ZopePageTemplate.__new__(ZopePageTemplate)
+    ob._cook = cached_cook(ob, compile_cache)
+    try:
+        ob.__init__(source.name, text=source.read().decode('UTF-8'),
+                    content_type='text/html')
+    finally:
+        del ob._cook
+    return ob
 
 
-@loader(condition=detect_image)
-def load_image(filename):
-    id = os.path.basename(filename)
-    ob = Image(id, '', '')
-    ob.update_data(file(filename, 'rb').read())
+class RecordingEngine(object):
+    """A TALES engine that remembers the source of every expression.
+
+    Compiled expressions often can't be pickled (path expressions keep
+    bound methods), so the compile cache stores their source instead.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.sources = {}
+        # keeps the ids in sources from being reused
+        self.compiled = []
+
+    def compile(self, expression):
+        compiled = self.engine.compile(expression)
+        self.sources[id(compiled)] = expression
+        self.compiled.append(compiled)
+        return compiled
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+
+def cached_cook(ob, compile_cache):
+    """Replacement for ZopePageTemplate._cook() that uses the compile cache.
+
+    The cached state is whatever volatile attributes _cook() sets (the TAL
+    program, the macros and so on); templates with errors are not cached.
+    Expressions are compiled again when a template is loaded from the
+    cache, which is still much cheaper than parsing it.
+    """
+    def cook():
+        engine = ob.pt_getEngine()
+        key = compile_cache.key('template', ob._text, ob.content_type,
+                                ob.pt_source_file())
+        state = compile_cache.get(key, [engine, engine], engine.compile)
+        if state is not None:
+            for name, value in state.items():
+                setattr(ob, name, value)
+            return
+        recorder = RecordingEngine(engine)
+        ob.pt_getEngine = lambda: recorder
+        try:
+            ZopePageTemplate._cook(ob)
+        finally:
+            del ob.pt_getEngine
+        if not ob._v_errors:
+            state = dict((name, value) for name, value in ob.__dict__.items()
+                         if name.startswith('_v_'))
+            compile_cache.put(key, state, [engine, recorder],
+                              recorder.sources)
+    return cook
+
+
+def cook_cached(ob, source):
+    # Volatile attributes are not pickled, so templates that come from a
+    # LoadCache need cooking; do it now, the same way load_pt() does
+    compile_cache = source.context.compile_cache
+    if compile_cache is not None and isinstance(ob, ZopePageTemplate):
+        cached_cook(ob, compile_cache)()
+
+
+def read_pdata(source):
+    jar = source.context.jar
+    if source.size < CHUNK_SIZE or jar is None:
+        # Without a database the object is rendered, not stored, and
+        # File.index_html() would stream a Pdata chain past the response
+        # body with RESPONSE.write()
+        data = source.read()
+        return data, len(data)
+    # Build the same Pdata chain OFS.Image.File builds for large uploads,
+    # without ever holding the whole file in a single string.  Chunks are
+    # saved and turned into ghosts as we go, so only a few of them are in
+    # memory at any time.
+    first = last = None
+    size = 0
+    for chunk in source.chunks():
+        data = Pdata(chunk)
+        size += len(chunk)
+        if last is None:
+            first = data
+        else:
+            last.next = data
+            add_chunk(source.context, last)
+        last = data
+    if last is None:
+        return '', 0
+    add_chunk(source.context, last)
+    return first, size
+
+
+def add_chunk(context, data):
+    # Counted across files: most files are only a few chunks long
+    context.jar.add(data)
+    unsaved = context.unsaved
+    unsaved.append(data)
+    if len(unsaved) >= SAVEPOINT_CHUNKS:
+        transaction.savepoint(optimistic=True)
+        for ob in unsaved:
+            ob._p_deactivate()
+        del unsaved[:]
+
+
+@loader(extensions=['.gif', '.png', '.jpg'])
+def load_image(source):
+    ob = Image(source.name, '', '')
+    # Image.update_data() would join the whole Pdata chain to find out the
+    # image size; the first chunk is enough for that
+    ob.update_data(source.head[:CHUNK_SIZE])
+    data, size = read_pdata(source)
+    File.update_data(ob, data, size=size)
     return ob
 
 
-@loader(condition=lambda filename: True, priority=LOWEST)
-def load_file(filename):
-    id = os.path.basename(filename)
-    ob = File(id, '', '')
-    ob.update_data(file(filename, 'rb').read())
+@loader(condition=lambda source: True, priority=LOWEST)
+def load_file(source):
+    ob = File(source.name, '', '')
+    data, size = read_pdata(source)
+    ob.update_data(data, size=size)
     return ob
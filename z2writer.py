@@ -17,9 +17,16 @@ in your Zope 2 distribution (without which this script is useless).
 """
 
 import os
+import sys
+import time
+import shutil
+import tempfile
+import Queue
+import itertools
+import threading
 
 from OFS.Folder import Folder
-from OFS.Image import Image, File
+from OFS.Image import File
 from OFS.interfaces import IPropertyManager
 from OFS.DTMLMethod import DTMLMethod
 from Products.PageTemplates.ZopePageTemplate import ZopePageTemplate
@@ -55,19 +62,384 @@ def class_name(cls):
     return '%s.%s' % (cls.__module__, cls.__name__)
 
 
-def write_object(ob, filename):
-    for priority, condition, handler in writer_registry:
-        if condition(ob):
+# See z2loader.METADATA_INDEX
+METADATA_INDEX = '__index__'
+
+# With more than one job, file contents waiting to be written by the worker
+# threads take up no more than this many bytes; larger payloads are written
+# directly.
+MAX_PENDING = 64 << 20
+
+
+class Output(object):
+    """Creates the files and directories produced by the writers.
+
+    With metadata_index=True, properties of all objects in a directory go
+    into a single .z2meta/__index__ file instead of a file per object.
+
+    With jobs > 1, files are written by that many worker threads.  Chunks
+    are still read on the calling thread (they may come from a ZODB
+    connection, which is not thread-safe), and directories are created
+    right away, so callers see no difference except speed.
+
+    With verbose=True, prints the size of every file written and the time
+    it took to produce (and, without worker threads, write) it.
+
+    With sync=True, the tree under ``root`` may already exist.  Files whose
+    contents are the same are left alone, other files are rewritten, and
+    close() removes whatever was not written and prints a summary.
+
+    With ``previous`` set to an older version of the tree being written to
+    ``root``, files that are the same as in the old tree are hard-linked
+    from there instead of being written (see start_staging()).
+
+    With ``destination`` set, ``root`` is a staging directory that will be
+    renamed to ``destination`` by finish_staging(); messages name files by
+    where they end up.
+    """
+
+    def __init__(self, metadata_index=False, jobs=1, verbose=False,
+                 sync=False, root=None, previous=None, destination=None):
+        assert root is not None or not (sync or previous or destination)
+        self.metadata_index = metadata_index
+        self.verbose = verbose
+        self.sync = sync
+        self.root = root
+        self.previous = previous
+        self.destination = destination
+        self.files_written = 0
+        self.bytes_written = 0
+        self.added = []
+        self.changed = []
+        self.removed = []
+        self.unchanged = 0
+        # guards the above, which worker threads update
+        self._lock = threading.Lock()
+        self._seen = set()
+        self._dirs = set()
+        self._indexes = {}
+        self._threads = []
+        self._errors = []
+        if jobs > 1:
+            self._queue = Queue.Queue()
+            self._pending = 0
+            self._pending_changed = threading.Condition()
+            for n in range(jobs):
+                thread = threading.Thread(target=self._worker)
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+
+    def mkdir(self, dirname):
+        if self.sync and os.path.lexists(dirname):
+            if not os.path.isdir(dirname) or os.path.islink(dirname):
+                os.unlink(dirname)
+                os.mkdir(dirname)
+        else:
+            os.mkdir(dirname)
+        self._dirs.add(dirname)
+
+    def makedirs(self, dirname):
+        if dirname not in self._dirs:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self._dirs.add(dirname)
+
+    def isdir(self, filename):
+        return filename in self._dirs
+
+    def write(self, filename, chunks):
+        """Write a file.
+
+        ``chunks`` is an iterable of strings.  In sync mode it may have to
+        be iterated twice; if it cannot be (e.g. it's a generator), it is
+        read into a list first.  A ``size`` attribute, if present, is used
+        as a hint for the total size.
+        """
+        start = time.time()
+        if self.sync:
+            self._seen.add(filename)
+        if self.sync or self.previous is not None:
+            if (not isinstance(chunks, (list, tuple))
+                    and not hasattr(chunks, 'size')):
+                chunks = list(chunks)
+        if self._threads:
+            size = self._queue_write(filename, chunks)
+        else:
+            size = self._write(filename, chunks)
+        self.files_written += 1
+        self.bytes_written += size
+        if self.verbose:
+            print "%10d bytes %8.3fs %s" % (size, time.time() - start,
+                                             self.display_name(filename))
+
+    def _queue_write(self, filename, chunks):
+        self._check_errors()
+        if getattr(chunks, 'size', 0) > MAX_PENDING:
+            return self._write(filename, chunks)
+        whole = chunks
+        chunks = iter(chunks)
+        data = []
+        size = 0
+        for chunk in chunks:
+            data.append(chunk)
+            size += len(chunk)
+            if size > MAX_PENDING:
+                if isinstance(whole, (list, tuple)):
+                    # _write() may have to read it twice (see write())
+                    return self._write(filename, whole)
+                return self._write(filename, itertools.chain(data, chunks))
+        self._pending_changed.acquire()
+        try:
+            while self._pending and self._pending + size > MAX_PENDING:
+                self._pending_changed.wait()
+            self._pending += size
+        finally:
+            self._pending_changed.release()
+        self._queue.put((filename, data, size))
+        return size
+
+    def _write(self, filename, chunks):
+        if self.sync:
+            reference = filename
+        elif self.previous is not None:
+            reference = self._previous_name(filename)
+        else:
+            reference = None
+        if reference is None:
+            return self._write_file(filename, chunks)
+        size = getattr(chunks, 'size', None)
+        if size is None:
+            size = sum(map(len, chunks))
+        if not os.path.lexists(reference):
+            self._count(self.added, filename)
+        elif os.path.isdir(reference) and not os.path.islink(reference):
+            if self.sync:
+                shutil.rmtree(reference)
+            self._count(self.changed, filename)
+        elif not file_matches(reference, chunks, size):
+            self._count(self.changed, filename)
+        else:
+            self._count(None, filename)
+            if reference == filename or link_file(reference, filename):
+                return size
+        return self._write_file(filename, chunks)
+
+    def _count(self, filenames, filename):
+        # filenames is self.added, self.changed or None for unchanged
+        self._lock.acquire()
+        try:
+            if filenames is None:
+                self.unchanged += 1
+            else:
+                filenames.append(filename)
+        finally:
+            self._lock.release()
+
+    def _previous_name(self, filename):
+        if filename == self.root:
+            return self.previous
+        prefix = os.path.join(self.root, '')
+        if filename.startswith(prefix):
+            return os.path.join(self.previous, filename[len(prefix):])
+        return None
+
+    def display_name(self, filename):
+        """Return the name of a file as it will be after finish_staging()."""
+        if self.destination is None:
+            return filename
+        # the staging directory has the same name as destination, and
+        # its parent stands for the parent of destination (see
+        # finish_staging() for the sidecar metadata file)
+        prefix = os.path.join(os.path.dirname(self.root), '')
+        if filename.startswith(prefix):
+            return os.path.join(os.path.dirname(self.destination),
+                                filename[len(prefix):])
+        return filename
+
+    def _write_file(self, filename, chunks):
+        size = 0
+        f = file(filename, 'wb')
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        finally:
+            f.close()
+        return size
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            filename, data, size = item
             try:
-                handler(ob, filename)
-            except:
-                warn("failed to write %s (%s)" % (filename, class_name(ob.__class__)))
-                raise
-            break
-    else:
-        warn("skipping %s (%s)" % (filename, class_name(ob.__class__)))
+                self._write(filename, data)
+            except Exception:
+                self._lock.acquire()
+                try:
+                    self._errors.append((filename, sys.exc_info()))
+                finally:
+                    self._lock.release()
+            self._pending_changed.acquire()
+            self._pending -= size
+            self._pending_changed.notifyAll()
+            self._pending_changed.release()
+
+    def _remove_stale(self):
+        for dirpath, dirnames, filenames in os.walk(self.root, topdown=False):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                if filename not in self._seen:
+                    os.unlink(filename)
+                    self.removed.append(filename)
+            for name in dirnames:
+                dirname = os.path.join(dirpath, name)
+                if os.path.islink(dirname):
+                    if dirname not in self._seen:
+                        os.unlink(dirname)
+                        self.removed.append(dirname)
+                elif dirname not in self._dirs:
+                    os.rmdir(dirname)
+
+    def report_changes(self):
+        for prefix, filenames in [('A', self.added), ('M', self.changed),
+                                  ('D', self.removed)]:
+            for filename in sorted(filenames):
+                print prefix, filename
+        print "%d added, %d changed, %d removed, %d unchanged" % (
+            len(self.added), len(self.changed), len(self.removed),
+            self.unchanged)
+
+    def _check_errors(self):
+        if self._errors:
+            filename, (exc_type, exc_value, tb) = self._errors[0]
+            warn("failed to write %s" % self.display_name(filename))
+            raise exc_type, exc_value, tb
+
+    def write_metadata(self, filename, lines):
+        dirname, name = os.path.split(filename)
+        if self.metadata_index:
+            index = self._indexes.setdefault(dirname, [])
+            index.append('[properties %s]\n' % name)
+            index.extend(lines)
+        else:
+            self.makedirs(dirname)
+            self.write(filename, ['[properties]\n'] + lines)
+
+    def close(self):
+        for dirname, lines in sorted(self._indexes.items()):
+            self.makedirs(dirname)
+            self.write(os.path.join(dirname, METADATA_INDEX), lines)
+        self._indexes.clear()
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._check_errors()
+        if self.sync:
+            if os.path.isdir(self.root):
+                self._remove_stale()
+            self.report_changes()
+        if self.verbose:
+            print "wrote %d files, %d bytes" % (self.files_written,
+                                                self.bytes_written)
+            if self.previous is not None:
+                print "%d unchanged files linked from %s" % (self.unchanged,
+                                                             self.previous)
+
+
+def file_matches(filename, chunks, size):
+    try:
+        f = file(filename, 'rb')
+    except IOError:
+        return False
+    try:
+        if os.fstat(f.fileno()).st_size != size:
+            return False
+        for chunk in chunks:
+            if f.read(len(chunk)) != chunk:
+                return False
+        return f.read(1) == ''
+    finally:
+        f.close()
+
+
+def link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        # e.g. the filesystem doesn't support hard links
+        return False
+    return True
+
+
+def start_staging(where):
+    """Pick a name to write a new version of ``where`` to.
+
+    The name is inside a new hidden directory next to ``where``, so that
+    finish_staging() can rename it into place when it's complete.
+    """
+    parent, name = os.path.split(os.path.abspath(where))
+    tmpdir = tempfile.mkdtemp(prefix='.%s.' % name, dir=parent)
+    return os.path.join(tmpdir, name)
+
+
+def finish_staging(staged, where):
+    tmpdir, name = os.path.split(staged)
+    parent = os.path.dirname(os.path.abspath(where))
+    old = os.path.join(tmpdir, '.old')
+    if os.path.lexists(where):
+        os.rename(where, old)
+    # there's no way to atomically swap two directories, but this leaves
+    # where missing only for the time between two renames
+    os.rename(staged, where)
+    # a single-file export also has its properties in a sidecar file
+    meta = os.path.join(tmpdir, '.z2meta', name)
+    if os.path.exists(meta):
+        if not os.path.isdir(os.path.join(parent, '.z2meta')):
+            os.mkdir(os.path.join(parent, '.z2meta'))
+        os.rename(meta, os.path.join(parent, '.z2meta', name))
+    shutil.rmtree(tmpdir)
+
+
+def abort_staging(staged):
+    # does nothing after finish_staging()
+    shutil.rmtree(os.path.dirname(staged), ignore_errors=True)
+
+
+def write_object(ob, filename, output=None):
+    if output is None:
+        output = Output()
+        write_object(ob, filename, output)
+        output.close()
+        return
+    handler = find_writer(ob)
+    if handler is None:
+        warn("skipping %s (%s)" % (output.display_name(filename),
+                                   class_name(ob.__class__)))
         return
-    write_metadata(ob, filename)
+    try:
+        handler(ob, filename, output)
+    except:
+        warn("failed to write %s (%s)" % (output.display_name(filename),
+                                          class_name(ob.__class__)))
+        raise
+    write_metadata(ob, filename, output)
+
+
+def find_writer(ob):
+    for priority, condition, handler in writer_registry:
+        if condition(ob):
+            return handler
+    return None
+
+
+def is_container(ob):
+    """Is ob written as a directory?"""
+    return find_writer(ob) is write_folder
 
 
 def metadata_filename(filename, isdir=None):
@@ -81,15 +453,11 @@ def metadata_filename(filename, isdir=None):
                             os.path.basename(filename))
 
 
-def write_metadata(ob, filename):
+def write_metadata(ob, filename, output):
     if not IPropertyManager.providedBy(ob):
         return
-    filename = metadata_filename(filename)
-    dirname = os.path.dirname(filename)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-    f = file(filename, 'w')
-    print >> f, '[properties]'
+    filename = metadata_filename(filename, output.isdir(filename))
+    lines = []
     for prop in sorted(ob.propertyMap(), key=lambda prop: prop['id']):
         key = '%s:%s' % (prop['id'], prop['type'])
         value = getattr(ob, prop['id'])
@@ -98,60 +466,73 @@ def write_metadata(ob, filename):
         if isinstance(value, unicode):
             value = value.encode('UTF-8')
         value = str(value).encode('string-escape')
-        print >> f, '%s = %s' % (key, value)
-    f.close()
+        lines.append('%s = %s\n' % (key, value))
+    output.write_metadata(filename, lines)
 
 
 @writer(Folder)
-def write_folder(folder, dirname):
-    os.mkdir(dirname)
+def write_folder(folder, dirname, output):
+    output.mkdir(dirname)
     for name, item in folder.objectItems():
-        write_object(item, os.path.join(dirname, name))
+        write_object(item, os.path.join(dirname, name), output)
+    # Let the connection drop objects that were written, so that a large
+    # site doesn't all end up in memory
+    jar = getattr(folder, '_p_jar', None)
+    if jar is not None:
+        jar.cacheGC()
 
 
 @writer(PythonScript)
-def write_py(script, filename):
-    f = file(filename, 'w')
-    f.write(script.read())
-    f.close()
+def write_py(script, filename, output):
+    output.write(filename, [script.read()])
 
 
 @writer(ZopePageTemplate)
-def write_pt(pt, filename):
-    f = file(filename, 'w')
+def write_pt(pt, filename, output):
     data = pt.read().encode('UTF-8')
-    f.write(data)
+    chunks = [data]
     if not data.endswith('\n'):
-        f.write('\n')
-    f.close()
+        chunks.append('\n')
+    output.write(filename, chunks)
 
 
-@writer(Image, priority=HIGH)
-def write_image(img, filename):
-    f = file(filename, 'wb')
-    data = img.data
-    if isinstance(data, str):
-        f.write(data)
-    else:
-        while data is not None:
-            f.write(data.data)
-            data = data.next
-    f.close()
+class PdataChunks(object):
+    """The contents of a File, one Pdata segment at a time.
 
+    Can be iterated over more than once (see Output.write()).
+    """
 
+    def __init__(self, fileobj):
+        self.data = fileobj.data
+        self.size = fileobj.get_size()
+
+    def __iter__(self):
+        data = self.data
+        if isinstance(data, str):
+            yield data
+            return
+        while data is not None:
+            yield data.data
+            next = data.next
+            jar = data._p_jar
+            # Don't keep the whole chain in the connection cache, unless the
+            # chunk was never saved (see z2loader.read_pdata()): turning it
+            # into a ghost would lose it
+            if jar is not None and data._p_oid not in jar._added:
+                data._p_deactivate()
+            data = next
+
+
+# Image is a subclass of File
 @writer(File, priority=HIGH)
-def write_file(fileobj, filename):
-    f = file(filename, 'wb')
-    f.write(str(fileobj))
-    f.close()
+def write_file(fileobj, filename, output):
+    output.write(filename, PdataChunks(fileobj))
 
 
 @writer(DTMLMethod)
-def write_dtml(dtml, filename):
-    f = file(filename, 'w')
+def write_dtml(dtml, filename, output):
     data = dtml.document_src()
-    f.write(data)
+    chunks = [data]
     if not data.endswith('\n'):
-        f.write('\n')
-    f.close()
-
+        chunks.append('\n')
+    output.write(filename, chunks)
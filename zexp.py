@@ -0,0 +1,1101 @@
+"""
+Reads Zope 2 export files (*.zexp) one record at a time.
+
+A zexp file is the string 'ZEXP', a number of records, and an end marker of
+16 '\xff' bytes.  Each record is an 8 byte oid, an 8 byte big-endian length
+and that many bytes of data: two pickles, one with the class of the object
+(or a (class, args) tuple) and one with its state.  References to other
+persistent objects are pickled as persistent ids, either an oid or an
+(oid, class) tuple.  The first record is the exported object; ZODB writes
+the rest in breadth-first order, so containers come before their contents.
+
+Usage:
+
+    StreamReader(file('site.zexp', 'rb'), children, write).run('site')
+
+To convert between zexp and the XML export format:
+
+    zexp_to_xml(file('site.zexp', 'rb'), file('site.xml', 'wb'))
+    xml_to_zexp(file('site.xml', 'rb'), file('site.zexp', 'wb'))
+
+To read just a part of an export:
+
+    fp = file('site.zexp', 'rb')
+    order, offsets = scan_records(fp)
+    oid = find_subobject(fp, offsets, order[0], 'news/2010')
+    reader = StreamReader(fp, children, write)
+    reader.offsets = offsets
+    reader.run('2010', subtree_records(fp, offsets, order, oid))
+
+Files compressed with gzip, bzip2 or xz can be opened with open_export().
+
+The record offsets, classes and paths of an export can be kept in an index
+file next to it, which makes looking into it quick:
+
+    zexp-index site.zexp ls news
+    zexp-index site.zexp cat news/index_html
+
+Blobs are not supported.
+
+Licenced under the Zope Public Licence (ZPL) version 2.1.  Find a copy
+in your Zope 2 distribution (without which this script is useless).
+"""
+
+import os
+import sys
+import bz2
+import collections
+import gzip
+import struct
+import pickle
+import optparse
+import weakref
+import cPickle
+import xml.parsers.expat
+from cStringIO import StringIO
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from persistent import Persistent, PickleCache
+from Acquisition import aq_base
+from ZODB.broken import find_global
+from ZODB.utils import p64
+from OFS.XMLExportImport import XMLrecord
+from Shared.DC.xml import ppml
+
+import z2writer
+
+
+MAGIC = 'ZEXP'
+END_MARKER = '\xff' * 16
+
+XML_HEADER = '<?xml version="1.0"?>\n<ZopeData>\n'
+XML_FOOTER = '</ZopeData>\n'
+
+CHUNK_SIZE = 1 << 16
+
+
+def open_gzip(filename, mode):
+    # gzip's own default level; 9 is much slower for little gain.  A fixed
+    # mtime in the header keeps the output reproducible.
+    return gzip.GzipFile(filename, mode, compresslevel=6, mtime=0)
+
+
+def open_lzma(filename, mode):
+    if lzma is None:
+        raise FormatError('%s: reading and writing .xz files needs the'
+                          ' lzma module (backports.lzma)' % filename)
+    return lzma.LZMAFile(filename, mode)
+
+
+# (extension, magic, opener)
+compression_registry = [
+    ('.gz', '\x1f\x8b', open_gzip),
+    ('.bz2', 'BZh', bz2.BZ2File),
+    ('.xz', '\xfd7zXZ\x00', open_lzma),
+]
+
+
+class FormatError(Exception):
+    pass
+
+
+def compression(filename, mode='rb'):
+    """Return the extension of the compression used for a file, or None.
+
+    Files that are read are recognized by their contents, files that are
+    written by their extension.
+    """
+    if 'r' in mode:
+        f = file(filename, 'rb')
+        try:
+            magic = f.read(6)
+        finally:
+            f.close()
+        for ext, compressed_magic, opener in compression_registry:
+            if magic.startswith(compressed_magic):
+                return ext
+        return None
+    for ext, compressed_magic, opener in compression_registry:
+        if filename.endswith(ext):
+            return ext
+    return None
+
+
+def strip_compression(filename):
+    """Remove a compression extension from a file name."""
+    for ext, compressed_magic, opener in compression_registry:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+def open_export(filename, mode='rb'):
+    """Open an export file, (de)compressing it on the fly if needed."""
+    ext = compression(filename, mode)
+    for other, compressed_magic, opener in compression_registry:
+        if ext == other:
+            return opener(filename, mode)
+    return file(filename, mode)
+
+
+def read_magic(fp):
+    if fp.read(4) != MAGIC:
+        raise FormatError('not a zexp file')
+
+
+def read_record(fp):
+    """Read one record and return (oid, data), or None at the end."""
+    header = fp.read(16)
+    if header == END_MARKER:
+        return None
+    if len(header) != 16:
+        raise FormatError('truncated export file')
+    oid = header[:8]
+    length, = struct.unpack('>Q', header[8:])
+    data = fp.read(length)
+    if len(data) != length:
+        raise FormatError('truncated export file')
+    return oid, data
+
+
+def read_records(fp, offsets=None):
+    """Iterate over (oid, data) of all records.
+
+    If ``offsets`` is a dict, it gets the file offset of every record.
+    """
+    read_magic(fp)
+    while True:
+        if offsets is not None:
+            pos = fp.tell()
+        record = read_record(fp)
+        if record is None:
+            break
+        if offsets is not None:
+            offsets[record[0]] = pos
+        yield record
+
+
+def scan_records(fp):
+    """Return a list of all oids in file order and a dict of their offsets.
+
+    Reads only the record headers.
+    """
+    read_magic(fp)
+    order = []
+    offsets = {}
+    while True:
+        pos = fp.tell()
+        header = fp.read(16)
+        if header == END_MARKER:
+            break
+        if len(header) != 16:
+            raise FormatError('truncated export file')
+        oid = header[:8]
+        length, = struct.unpack('>Q', header[8:])
+        order.append(oid)
+        offsets[oid] = pos
+        fp.seek(length, 1)
+    return order, offsets
+
+
+def read_record_at(fp, offset):
+    fp.seek(offset)
+    record = read_record(fp)
+    if record is None:
+        raise FormatError('no record at offset %d' % offset)
+    return record
+
+
+def ref_oid(ref):
+    if isinstance(ref, tuple):
+        return ref[0]
+    return ref
+
+
+def references(data):
+    """Return the oids of all objects a record refers to."""
+    refs = []
+    u = cPickle.Unpickler(StringIO(data))
+    # noload() doesn't build anything and appends persistent ids to a list
+    u.persistent_load = refs
+    u.noload()
+    u.noload()
+    return [ref_oid(ref) for ref in refs]
+
+
+class Reference(object):
+    """A reference to another object, as found by load_state()."""
+
+    def __init__(self, ref):
+        self.oid = ref_oid(ref)
+
+
+def load_state(data):
+    """Unpickle the state of a record, leaving references unresolved."""
+    u = unpickler(data, Reference)
+    u.load()
+    return u.load()
+
+
+def record_class(data):
+    """Return the dotted name of the class of a record."""
+    u = cPickle.Unpickler(StringIO(data))
+    u.find_global = lambda module, name: '%s.%s' % (module, name)
+    u.persistent_load = Reference
+    meta = u.load()
+    if isinstance(meta, tuple):
+        meta = meta[0]
+    if isinstance(meta, tuple):
+        meta = '.'.join(meta)
+    return meta
+
+
+def container_items(data):
+    """Return (name, oid) of the items in a folder record, or None.
+
+    Works for containers that keep their items in attributes, like
+    OFS.Folder does.
+    """
+    if '_objects' not in data:
+        # not worth unpickling
+        return None
+    try:
+        state = load_state(data)
+    except Exception:
+        return None
+    if not isinstance(state, dict) or '_objects' not in state:
+        return None
+    items = []
+    for item in state['_objects']:
+        name = item.get('id')
+        ref = state.get(name)
+        if isinstance(ref, Reference):
+            items.append((name, ref.oid))
+    return items
+
+
+def find_subobject(fp, offsets, oid, path):
+    """Find the oid of the object at path, looking into folder records.
+
+    Raises KeyError if there's no such object.
+    """
+    for name in path.split('/'):
+        if not name:
+            continue
+        data = read_record_at(fp, offsets[oid])[1]
+        items = dict(container_items(data) or ())
+        if name not in items or items[name] not in offsets:
+            raise KeyError(path)
+        oid = items[name]
+    return oid
+
+
+def reachable(fp, offsets, oid):
+    """Return the set of oids of all objects reachable from oid."""
+    seen = set([oid])
+    todo = [oid]
+    while todo:
+        data = read_record_at(fp, offsets[todo.pop()])[1]
+        for ref in references(data):
+            if ref not in seen and ref in offsets:
+                seen.add(ref)
+                todo.append(ref)
+    return seen
+
+
+def subtree_records(fp, offsets, order, oid):
+    """Iterate over the records of an object and all objects it refers to.
+
+    The object itself comes first, the rest in file order.
+    """
+    oids = reachable(fp, offsets, oid)
+    yield read_record_at(fp, offsets[oid])
+    for other in order:
+        if other in oids and other != oid:
+            yield read_record_at(fp, offsets[other])
+
+
+def write_xml(records, fp):
+    """Write (oid, data) records in the XML export format."""
+    fp.write(XML_HEADER)
+    for oid, data in records:
+        fp.write(XMLrecord(oid, len(data), data))
+    fp.write(XML_FOOTER)
+
+
+def zexp_to_xml(infp, outfp):
+    """Convert a zexp file to XML, one record at a time.
+
+    Gives the same output as OFS.XMLExportImport.exportXML().
+    """
+    write_xml(read_records(infp), outfp)
+
+
+class _ZopeData(object):
+    # Receives the records of an XML export as they are parsed
+
+    def __init__(self, fp):
+        self.fp = fp
+        fp.write(MAGIC)
+
+    def append(self, data):
+        self.fp.write(data)
+
+
+def _start_zopedata(parser, tag, attrs):
+    return _ZopeData(parser.file)
+
+
+def _end_zopedata(parser, tag, data):
+    parser.file.write(END_MARKER)
+    return data
+
+
+def _end_unicode(parser, tag, data):
+    # The text comes UTF-8 encoded (see xml_to_zexp())
+    data = data[:2] + [text.decode('utf-8') for text in data[2:]]
+    return ppml.save_unicode(parser, tag, data)
+
+
+def _end_reference(parser, tag, data):
+    # ppml.save_reference() has a NameError for memo ids of 256 and more
+    id = data[1]['id']
+    id = int(id[id.rfind('.') + 1:])
+    if id < 256:
+        return pickle.BINGET + chr(id)
+    return pickle.LONG_BINGET + struct.pack('<i', id)
+
+
+def _end_record(parser, tag, data):
+    oid = p64(int(data[1]['id']))
+    data = ''.join(data[2:])
+    return oid + p64(len(data)) + data
+
+
+def xml_to_zexp(infp, outfp, chunk_size=CHUNK_SIZE):
+    """Convert an XML export to a zexp file, one record at a time.
+
+    Works like OFS.XMLExportImport.importXML(), but parses the input
+    incrementally instead of reading it all into memory, and doesn't need
+    a seekable output file.
+    """
+    pickler = ppml.xmlPickler()
+    pickler.binary = 1
+    pickler.file = outfp
+    # importXML() changes the class attributes; don't
+    pickler.start_handlers = dict(pickler.start_handlers,
+                                  ZopeData=_start_zopedata)
+    pickler.end_handlers = dict(pickler.end_handlers,
+                                ZopeData=_end_zopedata, record=_end_record,
+                                unicode=_end_unicode,
+                                reference=_end_reference)
+    # The pickler drops whitespace-only text, so text split at a chunk
+    # boundary has to be put back together before it gets there
+    text = []
+    def flush():
+        if text:
+            pickler.handle_data(''.join(text))
+            del text[:]
+    def start(tag, attrs):
+        flush()
+        pickler.unknown_starttag(tag, attrs)
+    def end(tag):
+        flush()
+        pickler.unknown_endtag(tag)
+    parser = xml.parsers.expat.ParserCreate()
+    # ppml joins text with binary pickle opcodes, e.g. the length of a
+    # long string, which fails if the text is unicode
+    parser.returns_unicode = False
+    parser.CharacterDataHandler = text.append
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.buffer_text = True
+    while True:
+        chunk = infp.read(chunk_size)
+        if not chunk:
+            break
+        parser.Parse(chunk, False)
+    parser.Parse('', True)
+
+
+def is_seekable(fp):
+    # Compressed files can seek, but only by decompressing everything up
+    # to the new position (from the start, if it's backwards) again
+    if isinstance(fp, (gzip.GzipFile, bz2.BZ2File)):
+        return False
+    if lzma is not None and isinstance(fp, lzma.LZMAFile):
+        return False
+    try:
+        fp.seek(fp.tell())
+    except (AttributeError, IOError):
+        return False
+    return True
+
+
+class PushbackReader(object):
+    """Reads a file, and can seek back over what it read last.
+
+    Connection.importFile() seeks back a few bytes after every record,
+    which compressed files can only do by decompressing everything from
+    the start again.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.last = ''
+        self.pushed_back = ''
+
+    def read(self, size):
+        data = self.pushed_back[:size]
+        self.pushed_back = self.pushed_back[size:]
+        if len(data) < size:
+            data += self.fp.read(size - len(data))
+        self.last = data
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence != 1 or offset > 0 or -offset > len(self.last):
+            raise IOError('can only seek back over the last read')
+        if offset:
+            self.pushed_back = self.last[offset:] + self.pushed_back
+            self.last = self.last[:offset]
+
+    def close(self):
+        self.fp.close()
+
+
+def class_and_args(meta):
+    if isinstance(meta, tuple):
+        klass, args = meta
+        if isinstance(klass, tuple):
+            # very old databases pickle (module, name)
+            klass = find_global(*klass)
+        return klass, args or ()
+    return meta, ()
+
+
+def unpickler(data, persistent_load):
+    unpickler = cPickle.Unpickler(StringIO(data))
+    unpickler.find_global = find_global
+    unpickler.persistent_load = persistent_load
+    return unpickler
+
+
+# How many objects that were loaded again a StreamReader keeps in memory
+# (the same default a ZODB connection has)
+RELOAD_CACHE_SIZE = 400
+
+
+class _ReloadJar(object):
+    """Acts as the database connection of objects a StreamReader let go of.
+
+    They come back as ghosts, whose state is read from the file again when
+    it is needed, so following a long chain of them (e.g. the Pdata chunks
+    of a large File) doesn't load the whole chain at once.  Writers treat
+    them like objects in a ZODB connection and can turn them back into
+    ghosts (see z2writer.PdataChunks).
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self._cache = PickleCache(self, RELOAD_CACHE_SIZE)
+        self._added = {}
+
+    def get(self, oid):
+        return self._cache.get(oid)
+
+    def new_ghost(self, oid, ob):
+        self._cache.new_ghost(oid, ob)
+
+    def setstate(self, ob):
+        self.reader.setstate(ob)
+
+    def register(self, ob):
+        # Changes are never saved
+        pass
+
+    def cacheGC(self):
+        self._cache.incrgc()
+
+
+class StreamReader(object):
+    """Builds objects out of zexp records as they are read.
+
+    ``children(ob)`` returns a list of (name, child) pairs for objects that
+    are written as containers, and None for everything else.
+
+    ``write(ob, path)`` is called for every object that can be reached from
+    the root through containers: for containers as soon as their record is
+    read, for everything else once all the objects it references are loaded
+    as well.  After that the reader lets go of the object, so memory use is
+    bounded by the objects that are waiting for their references, not by
+    the size of the export.
+
+    An object that was already written may be referenced again later.  If
+    the file is seekable, it then comes back as a ghost that is loaded again
+    from the file when it is used; otherwise all loaded objects have to be
+    kept in memory.
+
+    Exports are written breadth first, so e.g. all Files of a folder come
+    before any of their data.  If the file is seekable, objects that have
+    to wait for their references don't keep their state in the meantime;
+    their records are read again once they are complete.
+    """
+
+    def __init__(self, fp, children, write):
+        self.fp = fp
+        self.children = children
+        self.write = write
+        self.seekable = is_seekable(fp)
+        if self.seekable:
+            self.offsets = {}
+            self.complete = weakref.WeakValueDictionary()
+            self.jar = _ReloadJar(self)
+        else:
+            self.offsets = None
+            self.complete = {}
+            self.jar = None
+        self.pinned = {}        # complete, but can't be weakly referenced,
+                                # and not written yet
+        self.completed = set()  # oids of all complete objects
+        self.incomplete = {}    # oid -> placeholder or object waiting for refs
+        self.paths = {}         # oid -> where to write it
+        self.waiting = {}       # oid -> number of incomplete objects it needs
+        self.waiters = {}       # oid -> oids of objects that need it
+        self.unloaded = set()   # oids of waiting objects without state
+        self._refs = []
+
+    def run(self, path, records=None):
+        """Read all records and write the first object to path.
+
+        Pass ``records`` to read a selection of records, e.g. from
+        subtree_records().  They must all come from self.fp, and then
+        self.offsets has to be set too, if the file is seekable.
+        """
+        if records is None:
+            records = read_records(self.fp, self.offsets)
+        root = True
+        for oid, data in records:
+            if root:
+                self.paths[oid] = path
+                root = False
+            self.load(oid, data)
+        # Whatever is left refers to itself in a cycle, or to records that
+        # are missing from the file
+        for oid in sorted(self.waiting):
+            path = self.paths.pop(oid, None)
+            if path is not None:
+                ob = self.incomplete[oid]
+                self.restore(oid, ob)
+                self.deliver(ob, path)
+        missing = len(self.incomplete) - len(self.waiting)
+        if missing:
+            print >> sys.stderr, ("%d referenced objects are missing from"
+                                  " the export" % missing)
+
+    def load(self, oid, data):
+        u = unpickler(data, self.persistent_load)
+        klass, args = class_and_args(u.load())
+        ob = self.incomplete.get(oid)
+        if ob is None:
+            ob = self.new(oid, klass, args)
+            self.incomplete[oid] = ob
+        self._refs = []
+        state = u.load()
+        refs = self._refs
+        ob.__setstate__(state)
+        if self.children(ob) is not None:
+            # children are written on their own, so don't wait for them
+            self.mark_complete(oid)
+            return
+        deps = set(refs)
+        deps.discard(oid)
+        deps.difference_update(self.completed)
+        if not deps:
+            self.mark_complete(oid)
+            return
+        self.waiting[oid] = len(deps)
+        for dep in deps:
+            self.waiters.setdefault(dep, []).append(oid)
+        if self.seekable:
+            self.unload(oid, ob)
+
+    def new(self, oid, klass, args=()):
+        ob = klass.__new__(klass, *args)
+        ob._p_oid = oid
+        return ob
+
+    def persistent_load(self, ref):
+        if isinstance(ref, tuple):
+            oid, klass = ref
+            if isinstance(klass, tuple):
+                klass = find_global(*klass)
+        elif isinstance(ref, str):
+            oid, klass = ref, None
+        else:
+            raise FormatError('unsupported reference: %r' % (ref, ))
+        self._refs.append(oid)
+        ob = self.incomplete.get(oid)
+        if ob is None:
+            ob = self.complete.get(oid)
+        if ob is None:
+            ob = self.pinned.get(oid)
+        if ob is None:
+            if oid in self.completed:
+                ob = self.reload(oid)
+            else:
+                if klass is None:
+                    raise FormatError('reference to a later record without'
+                                      ' a class: %r' % oid)
+                ob = self.new(oid, klass)
+                self.incomplete[oid] = ob
+        return ob
+
+    def read_again(self, oid):
+        pos = self.fp.tell()
+        oid, data = read_record_at(self.fp, self.offsets[oid])
+        self.fp.seek(pos)
+        return unpickler(data, self.persistent_load)
+
+    def unload(self, oid, ob):
+        # Objects that refer to it keep it, so just let go of its state
+        state = getattr(ob, '__dict__', None)
+        if state:
+            state.clear()
+            self.unloaded.add(oid)
+
+    def restore(self, oid, ob):
+        if oid in self.unloaded:
+            self.unloaded.discard(oid)
+            u = self.read_again(oid)
+            u.load()
+            self._refs = []
+            ob.__setstate__(u.load())
+
+    def reload(self, oid):
+        # The objects it refers to come back as ghosts too, so long
+        # chains of references are not read all at once
+        ob = self.jar.get(oid)
+        if ob is None:
+            u = self.read_again(oid)
+            klass, args = class_and_args(u.load())
+            ob = klass.__new__(klass, *args)
+            self.jar.new_ghost(oid, ob)
+        return ob
+
+    def setstate(self, ob):
+        # Called by the jar when a ghost from reload() is used, which may
+        # be in the middle of loading another record
+        refs = self._refs
+        u = self.read_again(ob._p_oid)
+        u.load()
+        ob.__setstate__(u.load())
+        self._refs = refs
+
+    def remember(self, oid, ob):
+        """Remember a complete object.
+
+        Objects that can't be weakly referenced are pinned instead, and let
+        go of once they are written.
+        """
+        try:
+            self.complete[oid] = ob
+        except TypeError:
+            self.pinned[oid] = ob
+
+    def mark_complete(self, oid):
+        todo = [oid]
+        while todo:
+            oid = todo.pop()
+            ob = self.incomplete.pop(oid)
+            self.waiting.pop(oid, None)
+            self.completed.add(oid)
+            self.remember(oid, ob)
+            self.restore(oid, ob)
+            path = self.paths.pop(oid, None)
+            if path is not None:
+                self.deliver(ob, path)
+            waiters = self.waiters.pop(oid, ())
+            if waiters:
+                # it will be written as part of the objects that refer
+                # to it, which hold on to it until then
+                self.pinned.pop(oid, None)
+            for waiter in waiters:
+                self.waiting[waiter] -= 1
+                if not self.waiting[waiter]:
+                    todo.append(waiter)
+
+    def deliver(self, ob, path):
+        self.write(ob, path)
+        self.pinned.pop(ob._p_oid, None)
+        if self.jar is not None:
+            self.jar.cacheGC()
+        children = self.children(ob)
+        for name, child in children or ():
+            oid = child._p_oid
+            child_path = os.path.join(path, name)
+            if oid in self.completed:
+                # the child's record came before its container's
+                self.deliver(child, child_path)
+            else:
+                self.paths[oid] = child_path
+
+
+def tree_reader(fp, output):
+    """Return a StreamReader that writes objects with z2writer."""
+    def children(ob):
+        if not z2writer.is_container(ob):
+            return None
+        return [(id, aq_base(ob._getOb(id))) for id in ob.objectIds()]
+    def write(ob, filename):
+        if z2writer.is_container(ob):
+            # its contents are written as they arrive
+            output.mkdir(filename)
+            z2writer.write_metadata(ob, filename, output)
+        else:
+            z2writer.write_object(ob, filename, output)
+    return StreamReader(fp, children, write)
+
+
+def write_records(records, fp):
+    """Write (oid, data) records in the zexp format."""
+    fp.write(MAGIC)
+    for oid, data in records:
+        fp.writelines([oid, p64(len(data)), data])
+    fp.write(END_MARKER)
+
+
+class StablePickler(pickle.Pickler):
+    """A pickler whose output depends only on the values it pickles.
+
+    Dicts are pickled with sorted keys, and strings are not memoized, so
+    equal strings give the same pickle whether or not they happen to be
+    the same object.
+    """
+
+    dispatch = pickle.Pickler.dispatch.copy()
+
+    def memoize(self, obj):
+        if type(obj) not in (str, unicode):
+            pickle.Pickler.memoize(self, obj)
+
+    def save_dict(self, obj):
+        if self.bin:
+            self.write(pickle.EMPTY_DICT)
+        else:
+            self.write(pickle.MARK + pickle.DICT)
+        self.memoize(obj)
+        self._batch_setitems(iter(sorted(obj.iteritems())))
+
+    dispatch[dict] = save_dict
+
+
+class RecordWriter(object):
+    """Pickles objects into export records, without a database.
+
+    Objects get new oids as they are found, and are pickled the same way
+    ZODB's ObjectWriter would do it.  Objects that are already stored in
+    ``jar`` (like the Pdata chunks z2loader saves into a savepoint) are
+    copied from there as they are.  New oids come from ``jar`` too, if
+    there is one, so they can't clash with the stored ones.
+
+    With ``first_oid`` set, stored objects are pickled again like all the
+    others and oids are numbered from first_oid in the order the objects
+    are written.  This lets several writers produce parts of one export.
+
+    With ``reproducible`` set, oids are numbered from 1 unless first_oid
+    says otherwise, and StablePickler is used, so the same objects always
+    give the same bytes.
+
+    Records are produced in the same breadth-first order as
+    Connection.exportFile() uses.
+    """
+
+    def __init__(self, jar=None, reproducible=False, first_oid=None):
+        self.jar = jar
+        self.reproducible = reproducible
+        self.renumber = reproducible or first_oid is not None
+        self._oids = {}     # id(ob) -> oid
+        self._objects = {}  # oid -> ob, so that ids don't get reused
+        self._seen = set()  # oids of stored objects
+        self._queue = collections.deque()
+        self._next_oid = first_oid or 1
+        self._file = StringIO()
+        if reproducible:
+            self._pickler = StablePickler(self._file, 1)
+            self._pickler.persistent_id = self.persistent_id
+        else:
+            self._pickler = cPickle.Pickler(self._file, 1)
+            self._pickler.inst_persistent_id = self.persistent_id
+
+    def new_oid(self):
+        if self.jar is not None and not self.renumber:
+            return self.jar.new_oid()
+        self._next_oid += 1
+        return p64(self._next_oid - 1)
+
+    def assign(self, ob, oid):
+        """Refer to ob by oid, without writing it."""
+        self._oids[id(ob)] = oid
+        self._objects[oid] = ob
+
+    def oid(self, ob):
+        if (ob._p_jar is not None and ob._p_oid is not None
+                and not self.renumber):
+            oid = ob._p_oid
+            if oid not in self._seen:
+                self._seen.add(oid)
+                self._queue.append((oid, None))
+            return oid
+        oid = self._oids.get(id(ob))
+        if oid is None:
+            oid = self._oids[id(ob)] = self.new_oid()
+            self._objects[oid] = ob
+            self._queue.append((oid, ob))
+        return oid
+
+    def persistent_id(self, ob):
+        if not isinstance(ob, Persistent):
+            return None
+        oid = self.oid(ob)
+        if hasattr(type(ob), '__getnewargs__'):
+            return oid
+        return oid, type(ob)
+
+    def serialize(self, ob):
+        newargs = getattr(ob, '__getnewargs__', None)
+        if newargs is None:
+            meta = type(ob)
+        else:
+            meta = type(ob), newargs()
+        self._file.seek(0)
+        self._pickler.clear_memo()
+        self._pickler.dump(meta)
+        self._pickler.dump(ob.__getstate__())
+        self._file.truncate()
+        if ob._p_jar is not None:
+            # loaded from the database just for this
+            ob._p_deactivate()
+        return self._file.getvalue()
+
+    def load(self, oid):
+        data = self.jar._storage.load(oid, '')[0]
+        for ref in references(data):
+            if ref not in self._seen:
+                self._seen.add(ref)
+                self._queue.append((ref, None))
+        return data
+
+    def records(self, ob):
+        """Iterate over (oid, data) of ob and everything it refers to."""
+        self.oid(ob)
+        while self._queue:
+            oid, ob = self._queue.popleft()
+            if ob is None:
+                yield oid, self.load(oid)
+            else:
+                yield oid, self.serialize(ob)
+
+    def write(self, ob, fp):
+        """Write ob and everything it refers to as a zexp file."""
+        write_records(self.records(ob), fp)
+
+
+INDEX_VERSION = 1
+
+
+def index_filename(filename):
+    return filename + '.idx'
+
+
+def build_index(fp):
+    """Scan an export and return {oid: (offset, length, class, path)}.
+
+    Paths are relative to the exported object ('' for the object itself);
+    objects that are not items of a folder have None.
+    """
+    offsets = {}
+    entries = {}
+    items = {}
+    root = None
+    for oid, data in read_records(fp, offsets):
+        if root is None:
+            root = oid
+        entries[oid] = [offsets[oid], len(data), record_class(data), None]
+        children = container_items(data)
+        if children:
+            items[oid] = children
+    if root is not None:
+        entries[root][3] = ''
+        todo = [root]
+        while todo:
+            oid = todo.pop()
+            for name, child in items.get(oid, ()):
+                entry = entries.get(child)
+                if entry is not None and entry[3] is None:
+                    entry[3] = '/'.join(filter(None, [entries[oid][3], name]))
+                    todo.append(child)
+    return dict((oid, tuple(entry)) for oid, entry in entries.items())
+
+
+class Index(object):
+    """Where to find the records of an export file."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.order = sorted(entries, key=lambda oid: entries[oid][0])
+        self.offsets = dict((oid, entry[0])
+                            for oid, entry in entries.items())
+        self.paths = dict((entry[3], oid) for oid, entry in entries.items()
+                          if entry[3] is not None)
+
+    def lookup(self, path):
+        """Return the oid of the object at path; raises KeyError."""
+        return self.paths[path.strip('/')]
+
+    def children(self, path):
+        """Return sorted (name, oid) of the items of a folder."""
+        path = path.strip('/')
+        prefix = path and path + '/'
+        return sorted((other[len(prefix):], oid)
+                      for other, oid in self.paths.items()
+                      if other.startswith(prefix) and other != path
+                      and '/' not in other[len(prefix):])
+
+
+def load_index(filename):
+    """Load the index of an export file, if there's an up to date one."""
+    try:
+        f = file(index_filename(filename), 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            version, size, mtime, entries = cPickle.load(f)
+        except Exception, e:
+            print >> sys.stderr, "ignoring broken index %s: %s: %s" % (
+                index_filename(filename), e.__class__.__name__, e)
+            return None
+    finally:
+        f.close()
+    st = os.stat(filename)
+    if (version, size, mtime) != (INDEX_VERSION, st.st_size, st.st_mtime):
+        return None
+    return Index(entries)
+
+
+def save_index(filename, entries):
+    st = os.stat(filename)
+    idxname = index_filename(filename)
+    tmpname = idxname + '.tmp'
+    try:
+        f = file(tmpname, 'wb')
+        try:
+            cPickle.dump((INDEX_VERSION, st.st_size, st.st_mtime, entries),
+                         f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmpname, idxname)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "cannot save index %s: %s" % (idxname, e)
+
+
+def open_index(filename, rebuild=False):
+    """Return the Index of an export file, building it if necessary.
+
+    The index is kept next to the file in FILENAME.idx and is rebuilt
+    when the export file changes.
+    """
+    index = None
+    if not rebuild:
+        index = load_index(filename)
+    if index is None:
+        fp = open_export(filename)
+        try:
+            entries = build_index(fp)
+        finally:
+            fp.close()
+        save_index(filename, entries)
+        index = Index(entries)
+    return index
+
+
+class StdoutOutput(z2writer.Output):
+    """Writes the contents of files to stdout and ignores everything else."""
+
+    def mkdir(self, dirname):
+        pass
+
+    def makedirs(self, dirname):
+        pass
+
+    def write(self, filename, chunks):
+        for chunk in chunks:
+            sys.stdout.write(chunk)
+
+    def write_metadata(self, filename, lines):
+        pass
+
+
+def list_folder(index, path):
+    for name, oid in index.children(path):
+        offset, length, klass, subpath = index.entries[oid]
+        print "%-40s %-50s %10d" % (name, klass, length)
+
+
+def cat_object(filename, index, path):
+    oid = index.lookup(path)
+    fp = open_export(filename)
+    def children(ob):
+        if z2writer.is_container(ob):
+            sys.exit('%s is a folder' % path)
+        return None
+    def write(ob, path):
+        z2writer.write_object(ob, path, StdoutOutput())
+    reader = StreamReader(fp, children, write)
+    reader.offsets = index.offsets
+    reader.run(path, subtree_records(fp, index.offsets, index.order, oid))
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] file.zexp'
+                                         ' [ls [PATH] | cat PATH]',
+                                   description='indexes a Zope 2 export'
+                                               ' file and looks inside it')
+    parser.add_option('--rebuild', action='store_true',
+                      help='rebuild the index even if it is up to date')
+    opts, args = parser.parse_args()
+    if not args or len(args) > 3:
+        parser.print_help()
+        sys.exit()
+    filename = args[0]
+    command = args[1:2]
+    path = ''.join(args[2:3])
+    try:
+        index = open_index(filename, rebuild=opts.rebuild)
+    except FormatError, e:
+        sys.exit(str(e))
+    try:
+        if not command:
+            print "%d records, %d in the folder tree" % (
+                len(index.entries), len(index.paths))
+        elif command == ['ls']:
+            index.lookup(path)
+            list_folder(index, path)
+        elif command == ['cat'] and path:
+            cat_object(filename, index, path)
+        else:
+            parser.error('unknown command: %s' % ' '.join(args[1:]))
+    except KeyError:
+        sys.exit('%s not found in %s' % (path, filename))
+
+
+if __name__ == '__main__':
+    main()